@@ -1,10 +1,9 @@
 ﻿using Microsoft.AspNetCore.Authorization;
 using Microsoft.AspNetCore.Mvc;
 using Microsoft.EntityFrameworkCore;
-using System.Diagnostics;
-using System.Text;
 using WebApplication1.DataContext;
 using WebApplication1.Models.MLModule;
+using WebApplication4.Services;
 
 namespace WebApplication1.Controllers
 {
@@ -13,10 +12,12 @@ namespace WebApplication1.Controllers
     public class MLStudentAnalysisController : ControllerBase
     {
         private readonly AppDbContext _context;
+        private readonly IAnalysisRunner _analysisRunner;
 
-        public MLStudentAnalysisController(AppDbContext context)
+        public MLStudentAnalysisController(AppDbContext context, IAnalysisRunner analysisRunner)
         {
             _context = context;
+            _analysisRunner = analysisRunner;
         }
 
         [Authorize]
@@ -182,44 +183,7 @@ namespace WebApplication1.Controllers
             int studentId,
             string scope)
         {
-            string pythonExePath = @"C:\Users\Rin\AppData\Local\Programs\Python\Python313\python.exe";
-            string scriptPath = @"D:\%UNIVER\pythonProject\main.py";
-
-            var psi = new ProcessStartInfo
-            {
-                FileName = pythonExePath,
-                Arguments = $"\"{scriptPath}\" {studentId} {scope}",
-                UseShellExecute = false,
-                RedirectStandardOutput = true,
-                RedirectStandardError = true,
-                CreateNoWindow = true,
-                StandardOutputEncoding = Encoding.UTF8,
-                StandardErrorEncoding = Encoding.UTF8
-            };
-
-            psi.Environment["PYTHONIOENCODING"] = "utf-8";
-            psi.Environment["PYTHONUTF8"] = "1";
-
-            string stdOut;
-            string stdErr;
-
-            try
-            {
-                using var process = new Process { StartInfo = psi };
-
-                process.Start();
-
-                stdOut = await process.StandardOutput.ReadToEndAsync();
-                stdErr = await process.StandardError.ReadToEndAsync();
-
-                await process.WaitForExitAsync();
-
-                if (process.ExitCode != 0)
-                {
-                    return null;
-                }
-            }
-            catch
+            if (!await _analysisRunner.RunAsync(studentId, scope))
             {
                 return null;
             }
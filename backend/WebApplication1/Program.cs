@@ -50,6 +50,10 @@ public class Startup
 
         services.AddScoped<IUserAuthService, UserAuthService>();
 
+        services.AddHttpClient();
+
+        services.AddSingleton<IAnalysisRunner, AnalysisRunner>();
+
         services.AddCors(options =>
         {
             options.AddDefaultPolicy(
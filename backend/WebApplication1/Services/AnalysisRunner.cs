@@ -0,0 +1,130 @@
+﻿using System.Collections.Concurrent;
+using System.Diagnostics;
+using System.Net.Http.Json;
+using System.Text;
+
+namespace WebApplication4.Services
+{
+    public interface IAnalysisRunner
+    {
+        // Runs the Python analysis for one student and scope; true if the analysis was saved
+        // (or there was nothing to analyse), false if Python failed.
+        Task<bool> RunAsync(int studentId, string scope);
+    }
+
+    // Singleton: concurrent requests for the same (studentId, scope) share one run,
+    // and at most MaxConcurrentRuns different students are analysed at the same time.
+    public class AnalysisRunner : IAnalysisRunner
+    {
+        private const string AnalysisServiceUrl = "http://127.0.0.1:8765/analyze";
+        private const string PythonExePath = @"C:\Users\Rin\AppData\Local\Programs\Python\Python313\python.exe";
+        private const string ScriptPath = @"D:\%UNIVER\pythonProject\main.py";
+
+        private static readonly int MaxConcurrentRuns = Math.Max(1, Environment.ProcessorCount / 2);
+
+        private readonly IHttpClientFactory _httpClientFactory;
+        private readonly SemaphoreSlim _slots = new SemaphoreSlim(MaxConcurrentRuns, MaxConcurrentRuns);
+        private readonly ConcurrentDictionary<(int StudentId, string Scope), Lazy<Task<bool>>> _inFlight = new();
+
+        public AnalysisRunner(IHttpClientFactory httpClientFactory)
+        {
+            _httpClientFactory = httpClientFactory;
+        }
+
+        public Task<bool> RunAsync(int studentId, string scope)
+        {
+            var key = (studentId, scope);
+            var run = _inFlight.GetOrAdd(key, k => new Lazy<Task<bool>>(() => RunAndForgetAsync(k)));
+            return run.Value;
+        }
+
+        private async Task<bool> RunAndForgetAsync((int StudentId, string Scope) key)
+        {
+            try
+            {
+                await _slots.WaitAsync();
+                try
+                {
+                    return await TryRunAnalysisServiceAsync(key.StudentId, key.Scope)
+                        ?? await RunPythonProcessAsync(key.StudentId, key.Scope);
+                }
+                finally
+                {
+                    _slots.Release();
+                }
+            }
+            finally
+            {
+                // Later requests start a new run: by then the data may have changed again.
+                _inFlight.TryRemove(key, out _);
+            }
+        }
+
+        private async Task<bool> RunPythonProcessAsync(int studentId, string scope)
+        {
+            var psi = new ProcessStartInfo
+            {
+                FileName = PythonExePath,
+                Arguments = $"\"{ScriptPath}\" {studentId} {scope}",
+                UseShellExecute = false,
+                RedirectStandardOutput = true,
+                RedirectStandardError = true,
+                CreateNoWindow = true,
+                StandardOutputEncoding = Encoding.UTF8,
+                StandardErrorEncoding = Encoding.UTF8
+            };
+
+            psi.Environment["PYTHONIOENCODING"] = "utf-8";
+            psi.Environment["PYTHONUTF8"] = "1";
+
+            try
+            {
+                using var process = new Process { StartInfo = psi };
+
+                process.Start();
+
+                // Both streams are drained together so a full stderr pipe cannot block the process.
+                var stdOut = process.StandardOutput.ReadToEndAsync();
+                var stdErr = process.StandardError.ReadToEndAsync();
+
+                await Task.WhenAll(stdOut, stdErr);
+                await process.WaitForExitAsync();
+
+                return process.ExitCode == 0;
+            }
+            catch
+            {
+                return false;
+            }
+        }
+
+        // Resident Python analysis server (main.py --serve): keeps data and model warm.
+        // Returns null only if the server could not be reached, so the caller falls back to
+        // spawning main.py. A timeout is a failure, not a fallback: the server is still running
+        // that analysis, and a second process would compute and save the same result again.
+        private async Task<bool?> TryRunAnalysisServiceAsync(int studentId, string scope)
+        {
+            try
+            {
+                var client = _httpClientFactory.CreateClient();
+                client.Timeout = TimeSpan.FromMinutes(2);
+
+                using var response = await client.PostAsJsonAsync(
+                    AnalysisServiceUrl,
+                    new { student_id = studentId, scope });
+
+                // 404: the server answered, there is simply nothing to analyse.
+                return response.IsSuccessStatusCode
+                    || response.StatusCode == System.Net.HttpStatusCode.NotFound;
+            }
+            catch (HttpRequestException)
+            {
+                return null;
+            }
+            catch (TaskCanceledException)
+            {
+                return false;
+            }
+        }
+    }
+}
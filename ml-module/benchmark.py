@@ -0,0 +1,419 @@
+"""
+Бенчмарк ML-аналізу без робочого SQL Server.
+
+Генерує синтетичну EduTestDB (subject, test, class, student,
+student_class_history, student_test) у локальний файл SQLite заданого
+масштабу. Потім проганяє на ній ті самі етапи, що й main.py: завантаження,
+навчання, пакетний аналіз усіх учнів і аналіз окремих учнів. Звітує час
+кожного етапу, пропускну здатність (учнів/с), пікову памʼять процесу (RSS)
+і час холодного старту main.py окремим процесом.
+
+    python benchmark.py --attempts 100000
+    python benchmark.py --attempts 10000000 --scope current_class --output bench.json
+
+Згенерована база кешується в .cache/bench і перевикористовується
+для тих самих параметрів (--regenerate — згенерувати заново).
+Дані читаються через main.SqliteRepository; збереження аналізів міряється
+на SQLite, тож не відображає вартість MERGE на SQL Server.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import shutil
+import argparse
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+import main
+
+
+BENCH_DIR = os.path.join(main.CACHE_DIR, "bench")
+
+GENERATE_CHUNK_ROWS = 1_000_000
+
+# Теми для назв тестів (у лапках, як у реальних назвах)
+TOPICS = [
+    "Дроби", "Рівняння", "Функції", "Геометрія", "Вірші", "Орфографія",
+    "Клітина", "Атоми", "Електрика", "Права людини", "Козацтво", "Мапи",
+    "Алгоритми", "Малюнок", "Біг", "Граматика",
+]
+
+BENCH_SCHEMA = """
+    CREATE TABLE subject (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+    CREATE TABLE test (
+        id INTEGER PRIMARY KEY, teacher_id INTEGER NOT NULL, name TEXT NOT NULL,
+        date_of_creating TEXT NOT NULL, subject_id INTEGER NOT NULL, max_score REAL NOT NULL
+    );
+    CREATE TABLE class (id INTEGER PRIMARY KEY, number INTEGER NOT NULL, letter TEXT NOT NULL);
+    CREATE TABLE student (
+        id INTEGER PRIMARY KEY, first_name TEXT NOT NULL, last_name TEXT NOT NULL,
+        patronymic_name TEXT, class_id INTEGER NOT NULL
+    );
+    CREATE TABLE student_class_history (
+        id INTEGER PRIMARY KEY, student_id INTEGER NOT NULL, class_id INTEGER NOT NULL,
+        date_from TEXT NOT NULL, date_to TEXT
+    );
+    CREATE TABLE student_test (
+        id INTEGER PRIMARY KEY, student_id INTEGER NOT NULL, test_id INTEGER NOT NULL,
+        score REAL, date_time_taken TEXT, state INTEGER NOT NULL
+    );
+"""
+
+BENCH_INDEXES = """
+    CREATE INDEX ix_student_test_student ON student_test (student_id, state);
+    CREATE INDEX ix_student_class_history_student ON student_class_history (student_id, class_id);
+"""
+
+
+# ============================================================
+# Генерація синтетичної бази
+# ============================================================
+
+def _iso(values: np.ndarray) -> np.ndarray:
+    """datetime64 → 'YYYY-MM-DD HH:MM:SS' (формат, у якому sqlite3 передає datetime-параметри)."""
+    return np.char.replace(np.datetime_as_string(values, unit="s"), "T", " ")
+
+
+def generate_database(path: str, attempts: int, students: int, tests: int, seed: int = 42):
+    """
+    Записує синтетичні дані в SQLite:
+      - предмети з тими самими id, що й SUBJECT_DIRECTION_MAP;
+      - кожен учень пройшов 1–3 класи, поточний — відкритий період (date_to = NULL);
+      - ~5% проходжень ще не завершені (state = 0, score = NULL).
+    """
+    rng = np.random.default_rng(seed)
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(BENCH_SCHEMA)
+
+    subject_ids = sorted(main.SUBJECT_DIRECTION_MAP)
+    conn.executemany(
+        "INSERT INTO subject (id, name) VALUES (?, ?)",
+        [(sid, f"Предмет {sid}") for sid in subject_ids],
+    )
+
+    test_subjects = rng.choice(subject_ids, tests)
+    test_topics = rng.integers(0, len(TOPICS), tests)
+    conn.executemany(
+        "INSERT INTO test (id, teacher_id, name, date_of_creating, subject_id, max_score) "
+        "VALUES (?, ?, ?, ?, ?, 12)",
+        [
+            # Кожен десятий тест — без лапок у назві («невизначена тема»)
+            (tid, 1, f"Тест {tid}" if tid % 10 == 0 else f"Тест {tid} «{TOPICS[topic]}»",
+             "2021-08-01 00:00:00", int(subj))
+            for tid, subj, topic in zip(range(1, tests + 1), test_subjects, test_topics)
+        ],
+    )
+
+    conn.executemany(
+        "INSERT INTO class (id, number, letter) VALUES (?, ?, ?)",
+        [(number * 4 + i + 1, number + 1, "АБВГ"[i]) for number in range(11) for i in range(4)],
+    )
+    n_classes = 44
+
+    # Історія класів: навчальні роки з 1 вересня, останній період відкритий
+    periods = rng.integers(1, 4, students)
+    history, current_class = [], np.empty(students, dtype=np.int64)
+    for sid, n in zip(range(1, students + 1), periods.tolist()):
+        first_class = int(rng.integers(1, n_classes - n + 2))
+        for k in range(n):
+            year = 2024 - n + 1 + k
+            date_to = None if k == n - 1 else f"{year + 1}-05-31"
+            history.append((sid, first_class + k, f"{year}-09-01", date_to))
+        current_class[sid - 1] = first_class + n - 1
+
+    conn.executemany(
+        "INSERT INTO student (id, first_name, last_name, patronymic_name, class_id) VALUES (?, ?, ?, ?, ?)",
+        [(sid, f"Імʼя{sid}", f"Прізвище{sid}", f"Побатькові{sid}", int(cls))
+         for sid, cls in zip(range(1, students + 1), current_class)],
+    )
+    conn.executemany(
+        "INSERT INTO student_class_history (student_id, class_id, date_from, date_to) VALUES (?, ?, ?, ?)",
+        history,
+    )
+
+    # Проходження: у кожного учня свій «рівень», бал — рівень ± шум
+    ability = rng.normal(7.5, 2.0, students)
+    start = np.datetime64("2022-09-01T08:00:00")
+    span_s = int((np.datetime64("2025-05-31T18:00:00") - start) / np.timedelta64(1, "s"))
+
+    next_id = 1
+    for offset in range(0, attempts, GENERATE_CHUNK_ROWS):
+        n = min(GENERATE_CHUNK_ROWS, attempts - offset)
+        student_ids = rng.integers(1, students + 1, n)
+        test_ids = rng.integers(1, tests + 1, n)
+        scores = np.clip(np.rint(ability[student_ids - 1] + rng.normal(0, 2.0, n)), 1, 12)
+        taken = _iso(start + rng.integers(0, span_s, n).astype("timedelta64[s]"))
+        state = (rng.random(n) >= 0.05).astype(np.int64)
+
+        scores_or_null = [None if st == 0 else sc for sc, st in zip(scores.tolist(), state.tolist())]
+        conn.executemany(
+            "INSERT INTO student_test (id, student_id, test_id, score, date_time_taken, state) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            zip(range(next_id, next_id + n), student_ids.tolist(), test_ids.tolist(),
+                scores_or_null, taken.tolist(), state.tolist()),
+        )
+        next_id += n
+
+    conn.executescript(BENCH_INDEXES)
+    conn.commit()
+    conn.close()
+
+
+# ============================================================
+# Підключення main.py до SQLite-бази бенчмарку
+# ============================================================
+
+def bind_main_to_sqlite(db_path: str, work_dir: str):
+    """
+    Робить SQLite-файл джерелом даних main.py, а кеші (модель, знімок,
+    словник тем) — тимчасовою текою, щоб заміри завжди були «холодними».
+    """
+    main.use_repository(main.SqliteRepository(db_path))
+    main.USE_SCORES_SNAPSHOT = False
+    main.MODEL_STORE_PATH = os.path.join(work_dir, "global_model.pkl")
+    main.SCORES_SNAPSHOT_PATH = os.path.join(work_dir, "student_test_snapshot.arrow")
+    main.TOPIC_DICTIONARY_PATH = os.path.join(work_dir, "topics.json")
+
+
+# ============================================================
+# Заміри
+# ============================================================
+
+def peak_rss_mb():
+    """Пікова памʼять процесу (None, якщо платформа її не повідомляє)."""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / 2**20, 1)
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux повертає КБ, macOS — байти
+    return round(maxrss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def _collect_stages(metrics_path: str, mode: str) -> dict:
+    """Сумарний час етапів main.py (за назвою) із рядка метрик."""
+    main.flush_metrics(mode)
+    with open(metrics_path, encoding="utf-8") as f:
+        entry = json.loads(f.readlines()[-1])
+
+    stages = {}
+    for record in entry["stages"]:
+        agg = stages.setdefault(record["stage"], {"calls": 0, "wall_s": 0.0})
+        agg["calls"] += 1
+        agg["wall_s"] = round(agg["wall_s"] + record["wall_s"], 6)
+    return {"split_s": entry["split_s"], "stages": stages}
+
+
+def work_copy(db_path: str, work_dir: str) -> str:
+    """
+    Копія бази в work_dir: заміри записують аналізи в student_analysis, а
+    згенерована база має лишатись незмінною для наступних запусків.
+    """
+    path = os.path.join(work_dir, os.path.basename(db_path))
+    shutil.copy(db_path, path)
+    return path
+
+
+def run_benchmark(db_path: str, scope: str, sample_students: int, verbose: bool = False) -> dict:
+    report = {"scope": scope}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        bind_main_to_sqlite(work_copy(db_path, work_dir), work_dir)
+        metrics_path = os.path.join(work_dir, "metrics.jsonl")
+        # Без tracemalloc: він суттєво сповільнює pandas і спотворив би пропускну здатність
+        main.enable_metrics(metrics_path, trace_memory=False)
+
+        out = sys.stdout if verbose else open(os.devnull, "w", encoding="utf-8")
+        try:
+            with redirect_stdout(out):
+                # 1) Пакетний аналіз: завантаження → навчання → усі учні
+                started = time.perf_counter()
+                df_all = main.load_all_scores_cached()
+                loaded = time.perf_counter()
+                model, scaler = main.get_global_model(df_all, retrain=True)
+                trained = time.perf_counter()
+                results = main.analyze_students_bulk(df_all, model, scaler, scope)
+                finished = time.perf_counter()
+                main.save_analyses(results)
+                saved = time.perf_counter()
+
+                n_students = int(df_all["student_id"].nunique())
+                report["batch"] = {
+                    "attempts": len(df_all),
+                    "students": n_students,
+                    "analyses": len(results),
+                    "load_s": round(loaded - started, 3),
+                    "train_s": round(trained - loaded, 3),
+                    "analyze_s": round(finished - trained, 3),
+                    "total_s": round(finished - started, 3),
+                    "save_s": round(saved - finished, 3),
+                    "students_per_s": round(n_students / (finished - trained), 1),
+                    "end_to_end_students_per_s": round(n_students / (finished - started), 1),
+                    **_collect_stages(metrics_path, "benchmark-batch"),
+                }
+
+                # 2) Окремі учні: швидкий шлях (лише рядки учня + збережена модель)
+                rng = np.random.default_rng(0)
+                sample = rng.choice(np.sort(df_all["student_id"].unique()),
+                                    min(sample_students, n_students), replace=False)
+                latencies = []
+                for student_id in sample.tolist():
+                    started = time.perf_counter()
+                    period = main.get_current_class_period(student_id) if scope == "current_class" else None
+                    handled, _ = main.analyze_student_fast(student_id, scope, period)
+                    latencies.append(time.perf_counter() - started)
+                    if not handled:
+                        raise RuntimeError(f"швидкий шлях не спрацював для student_id={student_id}")
+
+                latencies = np.array(latencies)
+                report["single"] = {
+                    "students": len(latencies),
+                    "mean_ms": round(latencies.mean() * 1000, 2),
+                    "p50_ms": round(np.percentile(latencies, 50) * 1000, 2),
+                    "p95_ms": round(np.percentile(latencies, 95) * 1000, 2),
+                    "students_per_s": round(len(latencies) / latencies.sum(), 1),
+                    **_collect_stages(metrics_path, "benchmark-single"),
+                }
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def _run_main(args: list[str], python_flags: list[str] = ()) -> tuple:
+    """Окремий процес `python main.py ...`: (секунди від запуску до виходу, stderr)."""
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, *python_flags, MAIN_SCRIPT, *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        encoding="utf-8", errors="replace", check=True,
+    )
+    return time.perf_counter() - started, proc.stderr
+
+
+def measure_startup(db_path: str, runs: int) -> dict:
+    """
+    Холодний старт процесу, як його запускає бекенд:
+      - `main.py --help` — лише імпорт модуля;
+      - `main.py <id> all` зі збереженою моделлю — швидкий шлях одного учня.
+    Окремо перевіряється (через -X importtime), чи швидкий шлях імпортує sklearn.
+    Процеси працюють з копією бази й кешем у тимчасовій теці.
+    """
+    student_id = "1"
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_args = ["--source", f"sqlite:{work_copy(db_path, work_dir)}", "--cache-dir", work_dir]
+
+        # Прогрів: збережена модель і словник тем для цієї бази
+        _run_main([student_id, "all", *source_args])
+
+        help_times = [_run_main(["--help"])[0] for _ in range(runs)]
+        fast_times = [_run_main([student_id, "all", *source_args])[0] for _ in range(runs)]
+
+        _, importtime = _run_main([student_id, "all", *source_args], ["-X", "importtime"])
+        imported = {line.split("|")[-1].strip() for line in importtime.splitlines() if "|" in line}
+
+    return {
+        "runs": runs,
+        "import_median_s": round(float(np.median(help_times)), 3),
+        "fast_path_median_s": round(float(np.median(fast_times)), 3),
+        "fast_path_imports_sklearn": "sklearn" in imported,
+    }
+
+
+def print_report(report: dict):
+    batch, single = report["batch"], report["single"]
+    print(f"\n>>> Пакетний аналіз (scope={report['scope']}): "
+          f"{batch['students']} учнів, {batch['attempts']} проходжень")
+    print(f"- завантаження {batch['load_s']} с, навчання {batch['train_s']} с, "
+          f"аналіз {batch['analyze_s']} с, разом {batch['total_s']} с "
+          f"(+ збереження в SQLite {batch['save_s']} с)")
+    print(f"- {batch['students_per_s']} учнів/с (аналіз), "
+          f"{batch['end_to_end_students_per_s']} учнів/с (від завантаження)")
+    for name, agg in sorted(batch["stages"].items(), key=lambda item: -item[1]["wall_s"]):
+        print(f"    {name}: {agg['wall_s']} с ({agg['calls']} викл.)")
+
+    print(f"\n>>> Окремі учні (швидкий шлях): {single['students']} учнів")
+    print(f"- середнє {single['mean_ms']} мс, p50 {single['p50_ms']} мс, p95 {single['p95_ms']} мс, "
+          f"{single['students_per_s']} учнів/с")
+    for name, agg in sorted(single["stages"].items(), key=lambda item: -item[1]["wall_s"]):
+        print(f"    {name}: {agg['wall_s']} с ({agg['calls']} викл.)")
+
+    print(f"\n>>> Пікова памʼять процесу (RSS): {report['peak_rss_mb']} МБ")
+
+    startup = report.get("startup")
+    if startup is not None:
+        print(f"\n>>> Холодний старт (медіана з {startup['runs']}): імпорт main.py {startup['import_median_s']} с, "
+              f"швидкий шлях одного учня {startup['fast_path_median_s']} с; "
+              f"sklearn імпортується: {'так' if startup['fast_path_imports_sklearn'] else 'ні'}")
+    print()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Бенчмарк ML-аналізу на синтетичній EduTestDB")
+    parser.add_argument("--attempts", type=int, default=100_000,
+                        help="кількість проходжень тестів (student_test), напр. 1000, 100000, 10000000")
+    parser.add_argument("--students", type=int,
+                        help="кількість учнів (за замовчуванням — attempts / 50)")
+    parser.add_argument("--tests", type=int, default=600, help="кількість тестів")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--scope", choices=("all", "current_class"), default="all")
+    parser.add_argument("--sample-students", type=int, default=50,
+                        help="скільки учнів аналізувати окремо (швидкий шлях)")
+    parser.add_argument("--db", help="шлях до SQLite-файлу (за замовчуванням — у .cache/bench)")
+    parser.add_argument("--regenerate", action="store_true", help="згенерувати базу заново")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="скільки разів запускати main.py для заміру холодного старту (0 — пропустити)")
+    parser.add_argument("--output", help="дописати звіт як JSON-рядок у цей файл")
+    parser.add_argument("--verbose", action="store_true", help="не приховувати вивід main.py")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    students = args.students or max(1, args.attempts // 50)
+
+    db_path = args.db or os.path.join(
+        BENCH_DIR, f"edutest_{args.attempts}_{students}_{args.tests}_{args.seed}.sqlite"
+    )
+    if args.regenerate or not os.path.exists(db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        print(f"Генерація {db_path} ...")
+        started = time.perf_counter()
+        generate_database(db_path, args.attempts, students, args.tests, args.seed)
+        print(f"Готово за {time.perf_counter() - started:.1f} с")
+
+    report = run_benchmark(db_path, args.scope, args.sample_students, args.verbose)
+    if args.startup_runs > 0:
+        report["startup"] = measure_startup(db_path, args.startup_runs)
+    report.update({
+        "timestamp": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "db": os.path.basename(db_path),
+        "attempts_generated": args.attempts,
+    })
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(report, ensure_ascii=False) + "\n")
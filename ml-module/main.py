@@ -1,12 +1,27 @@
+import os
 import sys
 import re
+import json
+import pickle
+import hashlib
+import math
+import sqlite3
+import argparse
+import threading
+import time
+import cProfile
+import tracemalloc
 import urllib.parse
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache, wraps
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import numpy as np
 import pandas as pd
-import pyodbc
-from sqlalchemy import create_engine
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.tree import DecisionTreeClassifier
+from pandas.api.types import union_categoricals
 
 
 if sys.stdout.encoding.lower() != "utf-8":
@@ -25,6 +40,7 @@ TARGET_STUDENT_ID = 1  # ID студента, якого аналізуємо
 #   "all"           – аналіз всіх доступних результатів
 #   "current_class" – лише період поточного класу (за даними student та student_class_history)
 ANALYSIS_SCOPE = "all"  # або "current_class"
+ANALYSIS_SCOPES = ("all", "current_class")
 
 RAW_CONNECTION_STRING = (
     "DRIVER={ODBC Driver 17 for SQL Server};"
@@ -35,8 +51,13 @@ RAW_CONNECTION_STRING = (
     "TrustServerCertificate=yes;"
 )
 
-quoted_params = urllib.parse.quote_plus(RAW_CONNECTION_STRING)
-engine = create_engine(f"mssql+pyodbc:///?odbc_connect={quoted_params}")
+# Джерело даних:
+#   "mssql"        – робоча БД за RAW_CONNECTION_STRING
+#   "sqlite:<шлях>" – локальна копія EduTestDB у файлі SQLite (див. SqliteRepository)
+DATA_SOURCE = "mssql"
+
+# Локальні кеші модуля (знімок даних, модель, словник тем)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
 
 # subject_id → напрямок навчання
 SUBJECT_DIRECTION_MAP = {
@@ -79,6 +100,145 @@ CAREER_SUGGESTIONS = {
     "Інше": "індивідуально підібрані міждисциплінарні освітні траєкторії",
 }
 
+# ============================================================
+# 0.1. Вимірювання етапів: час, кількість рядків, пікова памʼять
+# ============================================================
+
+# Файл метрик (JSON Lines, один рядок на запуск/запит); None — вимірювання вимкнене
+METRICS_PATH = None
+
+# Етап → частина конвеєра, між якими ділимо загальний час
+STAGE_KINDS = ("db", "training", "recommendations", "persistence")
+
+_metrics_records = []
+_metrics_lock = threading.Lock()
+_stage_local = threading.local()
+
+
+def enable_metrics(path: str, trace_memory: bool = True):
+    """
+    trace_memory=False — лише час і рядки, без накладних витрат tracemalloc
+    (для замірів пропускної здатності).
+    """
+    global METRICS_PATH
+    METRICS_PATH = path
+    # Пікова памʼять — через tracemalloc (numpy/pandas теж звітують туди свої буфери)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def _rows_of(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, list)):
+        return len(value)
+    return None
+
+
+@contextmanager
+def stage(name: str, kind: str = None):
+    """
+    Вимірює один етап. Вкладені етапи записуються окремо (depth),
+    пік памʼяті зовнішнього етапу враховує піки вкладених.
+    """
+    if METRICS_PATH is None:
+        yield {}
+        return
+
+    stack = getattr(_stage_local, "stack", None)
+    if stack is None:
+        stack = _stage_local.stack = []
+
+    tracing = tracemalloc.is_tracing()
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1]["_peak"] = max(stack[-1]["_peak"], peak)
+    if tracing:
+        tracemalloc.reset_peak()
+
+    record = {
+        "stage": name,
+        "kind": kind,
+        "depth": len(stack),
+        # Вкладений етап того самого виду (upsert усередині save_analyses) вже
+        # врахований зовнішнім і не додається до розподілу часу вдруге
+        "nested": any(r["kind"] == kind for r in stack),
+        "_peak": current,
+    }
+    stack.append(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["wall_s"] = round(time.perf_counter() - started, 6)
+        stack.pop()
+
+        peak = max(record.pop("_peak"), tracemalloc.get_traced_memory()[1])
+        if tracing:
+            record["peak_mem_mb"] = round(peak / 2**20, 3)
+            record["mem_growth_mb"] = round((peak - current) / 2**20, 3)
+        if stack:
+            stack[-1]["_peak"] = max(stack[-1]["_peak"], peak)
+
+        with _metrics_lock:
+            _metrics_records.append(record)
+
+
+def timed_stage(kind: str):
+    """
+    Декоратор: функція стає етапом з назвою функції.
+    Записує вхідні рядки (перший аргумент-таблиця/список) і рядки результату.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if METRICS_PATH is None:
+                return fn(*args, **kwargs)
+
+            with stage(fn.__name__, kind) as record:
+                input_rows = next((n for n in map(_rows_of, args) if n is not None), None)
+                if input_rows is not None:
+                    record["input_rows"] = input_rows
+
+                result = fn(*args, **kwargs)
+
+                rows = _rows_of(result)
+                if rows is not None:
+                    record["rows"] = rows
+                return result
+        return wrapper
+    return decorator
+
+
+def flush_metrics(mode: str, **fields):
+    """
+    Дописує в METRICS_PATH один JSON-рядок із зібраними етапами
+    та розподілом часу між БД, навчанням, рекомендаціями і збереженням.
+    """
+    if METRICS_PATH is None:
+        return
+
+    with _metrics_lock:
+        records = list(_metrics_records)
+        _metrics_records.clear()
+
+    split = {kind: 0.0 for kind in STAGE_KINDS}
+    for record in records:
+        if record["kind"] in split and not record["nested"]:
+            split[record["kind"]] += record["wall_s"]
+
+    entry = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "mode": mode,
+        **fields,
+        "split_s": {kind: round(seconds, 6) for kind, seconds in split.items()},
+        "peak_mem_mb": max((r["peak_mem_mb"] for r in records if "peak_mem_mb" in r), default=None),
+        "stages": records,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(METRICS_PATH)), exist_ok=True)
+    with _metrics_lock, open(METRICS_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+
 # ============================================================
 # Рівні успішності за 12-бальною шкалою
 # ============================================================
@@ -115,8 +275,11 @@ def level_to_name(level: int) -> str:
 
 def format_forecast_level(score: float) -> str:
     """
-    Формат для прогнозу: "достатній (8 балів)"
+    Формат для прогнозу: "достатній (8 балів)". Прогноз NaN (у напрямку
+    лише один-два рядки і серед них NULL бал) — "невідомий рівень".
     """
+    if math.isnan(score):
+        return "невідомий рівень"
     lvl = score_to_level(score)
     short = LEVEL_SHORT_NAME.get(lvl, "невідомий рівень")
     return f"{short} ({round(score)} балів)"
@@ -126,6 +289,9 @@ def format_forecast_level(score: float) -> str:
 # Витяг теми з назви тесту
 # ============================================================
 
+TOPIC_PATTERN = re.compile(r"[\"'«»“”„‟‚‘’`](.+?)[\"'«»“”„‟‚‘’`]")
+
+
 def extract_topic_from_test_name(test_name: str) -> str:
     """
     Витягує тему з назви тесту:
@@ -135,24 +301,107 @@ def extract_topic_from_test_name(test_name: str) -> str:
     if not isinstance(test_name, str):
         return "невизначена тема"
 
-    pattern = r"[\"'«»“”„‟‚‘’`](.+?)[\"'«»“”„‟‚‘’`]"
-    m = re.search(pattern, test_name)
+    m = TOPIC_PATTERN.search(test_name)
     if m:
         return m.group(1).strip()
     return "невизначена тема"
 
 
 # ============================================================
-# 1. Завантаження даних з БД (усі учні)
+# Словник тем: test_id → тема, тема → стабільний topic_id
 # ============================================================
 
-def load_all_scores() -> pd.DataFrame:
+TOPIC_DICTIONARY_PATH = os.path.join(CACHE_DIR, "topics.json")
+
+
+@contextmanager
+def _file_lock(path: str, timeout: float = 30.0):
     """
-    Витягуємо ВСІ проходження тестів (усіх студентів) зі state = 1.
-    (Без урахування класів — клас/період підтягуємо окремо через student_class_history.)
+    Міжпроцесне блокування через lock-файл (O_EXCL працює і на Windows).
+    Файл, що лишився від аварійно завершеного процесу, знімається після timeout.
+    """
+    lock_path = path + ".lock"
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                deadline = time.monotonic() + timeout
+            time.sleep(0.05)
+
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+def _read_topic_dictionary() -> dict:
+    """
+    {"tests": {"<test_id>": {"name": ..., "topic": ...}}, "topics": {"<тема>": topic_id}}
+    """
+    if not os.path.exists(TOPIC_DICTIONARY_PATH):
+        return {"tests": {}, "topics": {}}
+    with open(TOPIC_DICTIONARY_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_topic_dictionary(dictionary: dict):
+    os.makedirs(os.path.dirname(TOPIC_DICTIONARY_PATH), exist_ok=True)
+    tmp_path = TOPIC_DICTIONARY_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(dictionary, f, ensure_ascii=False)
+    os.replace(tmp_path, TOPIC_DICTIONARY_PATH)
+
+
+def resolve_test_topics(test_ids: list[int], test_names: list[str]):
+    """
+    Теми та topic_id для різних тестів. Регулярний вираз запускається лише
+    для тестів, яких ще немає в словнику (або які перейменували);
+    нові теми отримують наступний вільний topic_id, старі id не змінюються.
+    Повертає (topics, topic_ids) у порядку test_ids.
     """
-    query = """
+    dictionary = _read_topic_dictionary()
+
+    def is_known(test_id, name):
+        entry = dictionary["tests"].get(str(test_id))
+        return entry is not None and entry["name"] == name
+
+    if not all(is_known(t, n) for t, n in zip(test_ids, test_names)):
+        os.makedirs(os.path.dirname(TOPIC_DICTIONARY_PATH), exist_ok=True)
+        with _file_lock(TOPIC_DICTIONARY_PATH):
+            # Перечитуємо під блокуванням: інший процес міг уже дописати словник
+            dictionary = _read_topic_dictionary()
+
+            for test_id, name in zip(test_ids, test_names):
+                if is_known(test_id, name):
+                    continue
+                topic = extract_topic_from_test_name(name)
+                dictionary["tests"][str(test_id)] = {"name": name, "topic": topic}
+                if topic not in dictionary["topics"]:
+                    dictionary["topics"][topic] = len(dictionary["topics"])
+
+            _write_topic_dictionary(dictionary)
+
+    topics = [dictionary["tests"][str(t)]["topic"] for t in test_ids]
+    topic_ids = [dictionary["topics"][topic] for topic in topics]
+    return topics, topic_ids
+
+
+# ============================================================
+# 1. Завантаження даних з БД (усі учні)
+# ============================================================
+
+SCORES_QUERY = """
     SELECT
+        st.[id] AS student_test_id,
         st.[student_id],
         s.[first_name],
         s.[last_name],
@@ -164,280 +413,1623 @@ def load_all_scores() -> pd.DataFrame:
         t.[name] AS test_name,
         subj.[id] AS subject_id,
         subj.[name] AS subject_name
-    FROM [EduTestDB].[dbo].[student_test] AS st
-        INNER JOIN [EduTestDB].[dbo].[student] AS s
+    FROM {schema}[student_test] AS st
+        INNER JOIN {schema}[student] AS s
             ON s.[id] = st.[student_id]
-        INNER JOIN [EduTestDB].[dbo].[test] AS t
+        INNER JOIN {schema}[test] AS t
             ON t.[id] = st.[test_id]
-        INNER JOIN [EduTestDB].[dbo].[subject] AS subj
+        INNER JOIN {schema}[subject] AS subj
             ON subj.[id] = t.[subject_id]
     WHERE
-        st.[state] = 1;
+        st.[state] = 1
+"""
+
+
+SCORES_CHUNK_SIZE = 100_000  # рядків за одну порцію при потоковому читанні
+STUDENT_IDS_PER_QUERY = 500  # параметрів в одному IN (...): SQLite — до 999, SQL Server — до 2100
+
+# Текст, що повторюється в кожному рядку проходження
+SCORES_TEXT_COLUMNS = ["first_name", "last_name", "patronymic_name", "test_name", "subject_name"]
+SCORES_ID_COLUMNS = ["student_test_id", "student_id", "test_id", "state", "subject_id"]
+
+# Потрібні лише при завантаженні (знімок, словник тем) — не в резидентних даних
+SCORES_NAME_COLUMNS = ["last_name", "first_name", "patronymic_name"]
+SCORES_LOAD_ONLY_COLUMNS = SCORES_NAME_COLUMNS + ["student_test_id", "state", "test_name"]
+
+
+def _as_sorted_category(s: pd.Series) -> pd.Series:
+    """
+    Текстова колонка → category з відсортованими категоріями:
+    groupby/sort_values по ній дають той самий порядок, що й по рядках.
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        categories = s.cat.categories
+        if categories.is_monotonic_increasing:
+            return s
+        return s.cat.reorder_categories(sorted(categories))
+    return s.astype(pd.CategoricalDtype(sorted(s.dropna().unique())))
+
+
+def compact_scores_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Компактні типи для DataFrame результатів:
+      - імена, назви тестів і предметів → category;
+      - id → найменший достатній цілий тип;
+      - score → int8, якщо всі бали цілі (середні по int8 pandas рахує
+        у float64, тож результати аналізу не змінюються), інакше float64.
     """
-    df = pd.read_sql(query, engine)
+    for col in SCORES_TEXT_COLUMNS:
+        if col in df.columns:
+            df[col] = _as_sorted_category(df[col])
 
-    # Витягуємо тему з назви тесту
-    df["topic"] = df["test_name"].apply(extract_topic_from_test_name)
+    for col in SCORES_ID_COLUMNS:
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
 
-    # Кодуємо тему як категорію для моделі
-    df["topic_id"], _ = pd.factorize(df["topic"])
+    if "score" in df.columns and not pd.api.types.is_integer_dtype(df["score"]):
+        score = df["score"]
+        if score.notna().all() and (score % 1 == 0).all() and score.between(-128, 127).all():
+            df["score"] = score.astype(np.int8)
 
     return df
 
 
-# ============================================================
-# 1.1. Період поточного класу (через student + student_class_history)
-# ============================================================
-
-def get_current_class_period(student_id: int):
+def concat_score_chunks(chunks: list[pd.DataFrame]) -> pd.DataFrame:
     """
-    Визначає період поточного класу студента:
-      1) читаємо current_class_id з таблиці student;
-      2) шукаємо останній запис у student_class_history для цього class_id;
-      3) повертаємо (class_id, date_from, date_to).
-    Якщо date_to = NULL, вважаємо верхню межу 9999-12-31.
-    Якщо щось не знайшли — повертаємо (None, None, None).
+    Обʼєднує стиснені порції результату SCORES_QUERY
+    (категорії обʼєднуються без повернення до рядків).
     """
+    if len(chunks) == 1:
+        return chunks[0]
+
+    text_columns = {
+        col: union_categoricals([c[col] for c in chunks], sort_categories=True)
+        for col in SCORES_TEXT_COLUMNS
+    }
+    df = pd.concat([c.drop(columns=SCORES_TEXT_COLUMNS) for c in chunks], ignore_index=True)
+    for col, values in text_columns.items():
+        df[col] = values
+
+    return compact_scores_frame(df[chunks[0].columns])
 
-    # 1) Поточний class_id з профілю
-    q_profile = f"""
-        SELECT [class_id]
-        FROM [EduTestDB].[dbo].[student]
-        WHERE [id] = {student_id}
+
+@timed_stage("db")
+def add_topics(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Додає колонки topic (category) і topic_id. Тема визначається один раз
+    на test_id через словник тем, а не для кожного рядка.
     """
-    df_profile = pd.read_sql(q_profile, engine)
+    tests = df[["test_id", "test_name"]].drop_duplicates("test_id")
+    test_ids = tests["test_id"].astype(int).tolist()
+    topics, topic_ids = resolve_test_topics(test_ids, tests["test_name"].astype(object).tolist())
+
+    categories = sorted(set(topics))
+    category_code = {topic: i for i, topic in enumerate(categories)}
+
+    codes = df["test_id"].map(pd.Series([category_code[t] for t in topics], index=test_ids))
+    df["topic"] = pd.Categorical.from_codes(codes.to_numpy(dtype=np.int32), categories=categories)
 
-    if df_profile.empty or pd.isna(df_profile.iloc[0]["class_id"]):
-        print(f"DEBUG: student_id={student_id}: не знайдено current class у таблиці student")
-        return None, None, None
+    # Стабільний id теми для моделі (не залежить від порядку рядків)
+    df["topic_id"] = df["test_id"].map(pd.Series(topic_ids, index=test_ids)).astype(np.int32)
+
+    return df
 
-    current_class_id = int(df_profile.iloc[0]["class_id"])
-    print(f"DEBUG: student_id={student_id}: current_class_id={current_class_id}")
 
-    # 2) Період у цьому класі з історії
-    q_period = f"""
-        SELECT TOP 1 [date_from], [date_to]
-        FROM [EduTestDB].[dbo].[student_class_history]
-        WHERE [student_id] = {student_id} AND [class_id] = {current_class_id}
-        ORDER BY [date_from] DESC;
+def analysis_frame(df: pd.DataFrame) -> pd.DataFrame:
     """
-    df_period = pd.read_sql(q_period, engine)
+    Резидентна форма результатів для навчання, прогнозу й рекомендацій:
+    лише student_id, test_id, score, date_time_taken, subject_id/subject_name,
+    topic/topic_id (цілі типи й category — близько 18 байт на рядок замість 36).
+    ПІБ переносяться в довідник student_id → ПІБ і беруться з нього лише
+    під час формування результату (student_full_names).
+    """
+    remember_student_names(df)
+    df = df.drop(columns=[col for col in SCORES_LOAD_ONLY_COLUMNS if col in df.columns])
+    if "topic_id" in df.columns:
+        df["topic_id"] = pd.to_numeric(df["topic_id"], downcast="integer")
+    return df
 
-    if df_period.empty:
-        print(f"DEBUG: student_id={student_id}, class_id={current_class_id}: записів у student_class_history немає")
-        return current_class_id, None, None
 
-    date_from = df_period.iloc[0]["date_from"]
-    date_to = df_period.iloc[0]["date_to"]
+_STUDENT_NAMES: dict = {}  # student_id → "Прізвище Імʼя По батькові"
 
-    if pd.isna(date_to):
-        date_to = pd.to_datetime("9999-12-31")
 
-    print(f"DEBUG: student_id={student_id}, class_id={current_class_id}: "
-          f"period {date_from} .. {date_to}")
+def remember_student_names(df: pd.DataFrame):
+    if not set(SCORES_NAME_COLUMNS) <= set(df.columns) or df.empty:
+        return
 
-    return current_class_id, date_from, date_to
+    # ПІБ з першого рядка учня (списки, а не .loc по category-колонках)
+    first_rows = df.drop_duplicates("student_id")
+    _STUDENT_NAMES.update(zip(
+        first_rows["student_id"].astype(int).tolist(),
+        (
+            f"{last_name} {first_name} {patronymic_name}"
+            for last_name, first_name, patronymic_name in zip(
+                *(first_rows[col].tolist() for col in SCORES_NAME_COLUMNS)
+            )
+        ),
+    ))
 
 
-def filter_student_scope(df_student: pd.DataFrame) -> pd.DataFrame:
-    df = df_student.copy()
+def student_full_names(student_ids) -> dict:
+    """{student_id: ПІБ}; учнів, яких ще немає в довіднику, дочитує з БД."""
+    missing = [int(i) for i in student_ids if int(i) not in _STUDENT_NAMES]
+    if missing:
+        remember_student_names(compact_scores_frame(get_repository().student_names(missing)))
+    return {int(i): _STUDENT_NAMES.get(int(i)) for i in student_ids}
 
-    if ANALYSIS_SCOPE == "all":
-        return df
 
-    if ANALYSIS_SCOPE == "current_class":
-        class_id, date_from, date_to = get_current_class_period(TARGET_STUDENT_ID)
+class StudentIndex:
+    """
+    Результати, згруповані за student_id, з межами рядків кожного учня:
+    rows(student_id) — зріз за O(1) замість булевої маски по всій таблиці.
+    Сортування стабільне, тож у межах учня рядки йдуть у тому ж порядку,
+    що й у вихідній таблиці (від нього залежить розбиття однакових
+    date_time_taken у прогнозі та погіршенні).
+    """
 
-        if class_id is None or date_from is None:
-            return df
+    def __init__(self, df: pd.DataFrame):
+        order = np.argsort(df["student_id"].to_numpy(), kind="stable")
+        self.df = df.iloc[order]
 
-        mask = (
-            df["date_time_taken"] >= pd.to_datetime(date_from)
-        ) & (
-            df["date_time_taken"] <= pd.to_datetime(date_to)
-        )
+        ids = self.df["student_id"].to_numpy()
+        student_ids, starts = np.unique(ids, return_index=True)
+        ends = np.append(starts[1:], len(ids))
+        self._bounds = dict(zip(student_ids.tolist(), zip(starts.tolist(), ends.tolist())))
 
-        df_filtered = df[mask]
-        return df_filtered
+    @property
+    def empty(self) -> bool:
+        return self.df.empty
 
-    return df
+    def rows(self, student_id: int) -> pd.DataFrame:
+        start, end = self._bounds.get(int(student_id), (0, 0))
+        return self.df.iloc[start:end]
+
+
+def student_rows(scores, student_id: int) -> pd.DataFrame:
+    """Рядки одного учня з DataFrame або StudentIndex."""
+    if isinstance(scores, StudentIndex):
+        return scores.rows(student_id)
+    return scores[scores["student_id"] == student_id]
+
+
+@timed_stage("db")
+def load_all_scores() -> pd.DataFrame:
+    """
+    Витягуємо ВСІ проходження тестів (усіх студентів) зі state = 1.
+    (Без урахування класів — клас/період підтягуємо окремо через student_class_history.)
+    """
+    return analysis_frame(add_topics(get_repository().read_scores()))
+
+
+@timed_stage("db")
+def load_scores_watermark() -> tuple:
+    """
+    Дешева перевірка, чи змінились завершені тести: (кількість рядків
+    зі state = 1, максимальний student_test.id, сума їхніх балів).
+    Сума ловить дооцінені відкриті питання: бал уже завершеного тесту
+    змінюється, а кількість і id — ні.
+    """
+    return get_repository().scores_watermark()
 
 
 # ============================================================
-# 2. Навчання глобальної ML-моделі
+# Джерело даних: робоча БД (MSSQL) або локальна копія (SQLite)
 # ============================================================
 
-def train_global_model(df_all: pd.DataFrame):
-    df = df_all.copy()
-    df["level"] = df["score"].apply(score_to_level)
+class EduTestRepository(ABC):
+    """
+    Усе, що модуль читає з EduTestDB і записує в неї.
+    Реалізації: MssqlRepository (робоча БД) і SqliteRepository (локальний файл).
+    """
 
-    X = df[["score", "subject_id", "topic_id"]]
-    y = df["level"]
+    # Підтека CACHE_DIR для знімка, моделі та словника тем цього джерела
+    # (None — сам CACHE_DIR); кеші різних баз не повинні змішуватись
+    cache_name = None
+
+    @abstractmethod
+    def read_scores(self, student_id=None, taken_from=None, taken_to=None, student_ids=None) -> pd.DataFrame:
+        """
+        Завершені проходження (SCORES_QUERY, без тем) у компактних типах;
+        за потреби — лише одного учня (або списку student_ids) та/або
+        в межах date_time_taken.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def scores_watermark(self) -> tuple:
+        """(кількість рядків student_test зі state = 1, максимальний id, сума балів)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def student_score_signatures(self) -> pd.DataFrame:
+        """
+        Для кожного учня (student_id, cnt, max_taken, score_sum) його рядків
+        student_test зі state = 1. Зміна будь-якого значення означає, що
+        аналіз учня треба перерахувати: новий тест, перевірка відкритих
+        питань (state 0 → 1) чи зміна балу.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def current_class_period(self, student_id: int):
+        """(class_id, date_from, date_to) поточного класу учня (див. get_current_class_period)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def current_class_periods(self, student_ids=None) -> pd.DataFrame:
+        """
+        Те саме, що current_class_period, для всіх учнів (або student_ids) разом:
+        student_id, class_id, history_student_id (NULL — записів в історії
+        немає), date_from, date_to.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def class_student_ids(self, class_id: int) -> list[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def student_names(self, student_ids: list[int]) -> pd.DataFrame:
+        """student_id і колонки SCORES_NAME_COLUMNS для учнів student_ids."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_analyses(self, results: list[dict]) -> list[int]:
+        """Зберігає results однією транзакцією, повертає analysis_id у порядку results."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def student_scores_summary(self, student_id: int, taken_from=None, taken_to=None) -> tuple:
+        """
+        (кількість, максимальний date_time_taken, сума балів) тих самих рядків,
+        які повернув би read_scores — для порівняння з source_watermark.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stored_analysis(self, student_id: int, scope: str, class_id=None):
+        """(analysis_id, source_watermark) збереженого аналізу або None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def touch_analysis(self, analysis_id: int):
+        """Позначає аналіз як актуальний (generated_at = зараз) без перезапису вмісту."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stored_analysis_details(self, analysis_id: int) -> tuple:
+        """
+        (тексти, напрямки, слабкі теми) збереженого аналізу: кортеж, як
+        у split_recommendation_texts, і рядки student_analysis_direction
+        та student_analysis_weak_topics у порядку запису.
+        """
+        raise NotImplementedError
+
+    def for_worker(self) -> "EduTestRepository":
+        """Копія для процесу пулу — без відкритих підключень батьківського процесу."""
+        return self
+
+
+class SqlEduTestRepository(EduTestRepository):
+    """
+    Спільні запити для SQL-джерел. Підкласи задають префікс таблиць (schema),
+    синтаксис «перший рядок» і підключення для pd.read_sql (_connectable).
+    """
 
-    scaler = MinMaxScaler()
-    X_scaled = scaler.fit_transform(X)
+    schema = ""
+    top_one = ""    # "TOP 1 " для T-SQL
+    limit_one = ""  # " LIMIT 1" для SQLite
+
+    @abstractmethod
+    @contextmanager
+    def _connectable(self):
+        raise NotImplementedError
+
+    def _param(self, value):
+        """Параметр-дата у вигляді, який розуміє драйвер."""
+        return pd.Timestamp(value).to_pydatetime()
+
+    def _read_sql(self, query: str, params=None, **kwargs) -> pd.DataFrame:
+        with self._connectable() as con:
+            return pd.read_sql(query, con, params=params, **kwargs)
+
+    def _scores_query(self, student_id=None, taken_from=None, taken_to=None, student_ids=None) -> tuple:
+        """SCORES_QUERY з умовами на учня (учнів) та date_time_taken: (query, params)."""
+        extra_where, params = "", []
+        if student_id is not None:
+            extra_where += "\n        AND st.[student_id] = ?"
+            params.append(int(student_id))
+        if student_ids is not None:
+            extra_where += f"\n        AND st.[student_id] IN ({', '.join('?' * len(student_ids))})"
+            params.extend(int(i) for i in student_ids)
+        if taken_from is not None:
+            extra_where += "\n        AND st.[date_time_taken] >= ?"
+            params.append(self._param(taken_from))
+        if taken_to is not None:
+            extra_where += "\n        AND st.[date_time_taken] <= ?"
+            params.append(self._param(taken_to))
+
+        return SCORES_QUERY.format(schema=self.schema) + extra_where, tuple(params) or None
+
+    def read_scores(self, student_id=None, taken_from=None, taken_to=None, student_ids=None) -> pd.DataFrame:
+        """
+        Рядки читаються порціями по SCORES_CHUNK_SIZE і одразу стискаються,
+        тож у памʼяті ніколи не лежить увесь результат у вигляді рядків-обʼєктів.
+        """
+        query, params = self._scores_query(student_id, taken_from, taken_to, student_ids)
+
+        with self._connectable() as con:
+            chunks = [
+                compact_scores_frame(chunk)
+                for chunk in pd.read_sql(
+                    query, con, params=params, chunksize=SCORES_CHUNK_SIZE,
+                    parse_dates=["date_time_taken"],
+                )
+            ]
 
-    model = DecisionTreeClassifier(
-        criterion="gini",
-        max_depth=6,
-        random_state=42
-    )
-    model.fit(X_scaled, y)
+            if not chunks:
+                return compact_scores_frame(
+                    pd.read_sql(query, con, params=params, parse_dates=["date_time_taken"])
+                )
 
-    return model, scaler
+        return concat_score_chunks(chunks)
+
+    def student_score_signatures(self) -> pd.DataFrame:
+        df = self._read_sql(f"""
+            SELECT [student_id], COUNT(*) AS cnt, MAX([date_time_taken]) AS max_taken, SUM([score]) AS score_sum
+            FROM {self.schema}[student_test]
+            WHERE [state] = 1
+            GROUP BY [student_id];
+        """)
+        # Без NaN/NaT, щоб рядки можна було порівнювати як кортежі
+        df["max_taken"] = df["max_taken"].astype(str)
+        df["score_sum"] = df["score_sum"].fillna(0.0).astype(float)
+        return df
 
+    def scores_watermark(self) -> tuple:
+        df = self._read_sql(f"""
+            SELECT COUNT(*) AS cnt, MAX([id]) AS max_id, SUM([score]) AS score_sum
+            FROM {self.schema}[student_test]
+            WHERE [state] = 1;
+        """)
+        cnt = int(df.iloc[0]["cnt"])
+        max_id = df.iloc[0]["max_id"]
+        score_sum = df.iloc[0]["score_sum"]
+        return (
+            cnt,
+            None if pd.isna(max_id) else int(max_id),
+            0.0 if pd.isna(score_sum) else round(float(score_sum), 4),
+        )
 
-def apply_model_to_student(df_student: pd.DataFrame, model, scaler) -> pd.DataFrame:
-    df = df_student.copy()
-    X = df[["score", "subject_id", "topic_id"]]
-    X_scaled = scaler.transform(X)
-    df["predicted_level"] = model.predict(X_scaled)
-    return df
+    def current_class_period(self, student_id: int):
+        # Поточний class_id з профілю і останній період у цьому класі з історії —
+        # одним запитом (h.[student_id] відрізняє «запису в історії немає»)
+        df = self._read_sql(f"""
+            SELECT {self.top_one}s.[class_id], h.[student_id] AS history_student_id, h.[date_from], h.[date_to]
+            FROM {self.schema}[student] AS s
+            LEFT JOIN {self.schema}[student_class_history] AS h
+                ON h.[student_id] = s.[id] AND h.[class_id] = s.[class_id]
+            WHERE s.[id] = ?
+            ORDER BY h.[date_from] DESC{self.limit_one};
+        """, params=(int(student_id),), parse_dates=["date_from", "date_to"])
+
+        if df.empty or pd.isna(df.iloc[0]["class_id"]):
+            print(f"DEBUG: student_id={student_id}: не знайдено current class у таблиці student")
+            return None, None, None
+
+        current_class_id = int(df.iloc[0]["class_id"])
+        print(f"DEBUG: student_id={student_id}: current_class_id={current_class_id}")
+
+        if pd.isna(df.iloc[0]["history_student_id"]):
+            print(f"DEBUG: student_id={student_id}, class_id={current_class_id}: записів у student_class_history немає")
+            return current_class_id, None, None
+
+        date_from = df.iloc[0]["date_from"]
+        date_to = df.iloc[0]["date_to"]
+
+        if pd.isna(date_to):
+            date_to = pd.to_datetime("9999-12-31")
+
+        print(f"DEBUG: student_id={student_id}, class_id={current_class_id}: "
+              f"period {date_from} .. {date_to}")
+
+        return current_class_id, date_from, date_to
+
+    def current_class_periods(self, student_ids=None) -> pd.DataFrame:
+        # Останній запис історії для (учень, клас) — ROW_NUMBER замість TOP 1 на учня
+        query = f"""
+            SELECT s.[id] AS student_id, s.[class_id], h.[student_id] AS history_student_id,
+                   h.[date_from], h.[date_to]
+            FROM {self.schema}[student] AS s
+            LEFT JOIN (
+                SELECT [student_id], [class_id], [date_from], [date_to],
+                       ROW_NUMBER() OVER (
+                           PARTITION BY [student_id], [class_id] ORDER BY [date_from] DESC
+                       ) AS rn
+                FROM {self.schema}[student_class_history]
+            ) AS h
+                ON h.[student_id] = s.[id] AND h.[class_id] = s.[class_id] AND h.[rn] = 1
+        """
+        # Формат кожного значення окремо: у SQLite в одній колонці бувають
+        # і дати, і дати з часом
+        parse_dates = {col: {"format": "mixed"} for col in ("date_from", "date_to")}
+        if student_ids is None:
+            return self._read_sql(query, parse_dates=parse_dates)
+
+        parts = []
+        for start in range(0, len(student_ids), STUDENT_IDS_PER_QUERY):
+            ids = [int(i) for i in student_ids[start:start + STUDENT_IDS_PER_QUERY]]
+            parts.append(self._read_sql(
+                query + f"WHERE s.[id] IN ({', '.join('?' * len(ids))})",
+                params=tuple(ids), parse_dates=parse_dates,
+            ))
+        return pd.concat(parts, ignore_index=True)
+
+    def class_student_ids(self, class_id: int) -> list[int]:
+        df = self._read_sql(f"""
+            SELECT [id]
+            FROM {self.schema}[student]
+            WHERE [class_id] = ?
+        """, params=(int(class_id),))
+        return df["id"].astype(int).tolist()
+
+    def student_names(self, student_ids: list[int]) -> pd.DataFrame:
+        parts = []
+        for start in range(0, len(student_ids), STUDENT_IDS_PER_QUERY):
+            ids = [int(i) for i in student_ids[start:start + STUDENT_IDS_PER_QUERY]]
+            parts.append(self._read_sql(f"""
+                SELECT [id] AS student_id, [last_name], [first_name], [patronymic_name]
+                FROM {self.schema}[student]
+                WHERE [id] IN ({', '.join('?' * len(ids))})
+            """, params=tuple(ids)))
+        return pd.concat(parts, ignore_index=True)
+
+    def student_scores_summary(self, student_id: int, taken_from=None, taken_to=None) -> tuple:
+        query, params = self._scores_query(student_id, taken_from, taken_to)
+        df = self._read_sql(f"""
+            SELECT COUNT(*) AS cnt, MAX(q.[date_time_taken]) AS max_taken, SUM(q.[score]) AS score_sum
+            FROM ({query}) AS q
+        """, params=params)
+        row = df.iloc[0]
+        return (
+            int(row["cnt"]),
+            None if pd.isna(row["max_taken"]) else pd.Timestamp(row["max_taken"]),
+            0.0 if pd.isna(row["score_sum"]) else float(row["score_sum"]),
+        )
 
+    def _ensure_analysis_tables(self):
+        """Колонка source_watermark (або таблиці результатів) для старих баз."""
+
+    def stored_analysis(self, student_id: int, scope: str, class_id=None):
+        self._ensure_analysis_tables()
+        df = self._read_sql(f"""
+            SELECT {self.top_one}[id], [source_watermark]
+            FROM {self.schema}[student_analysis]
+            WHERE [student_id] = ? AND [scope] = ? AND ([scope] = 'all' OR [class_id] = ?)
+            ORDER BY [generated_at] DESC{self.limit_one};
+        """, params=(int(student_id), scope, None if class_id is None else int(class_id)))
+
+        if df.empty:
+            return None
+        watermark = df.iloc[0]["source_watermark"]
+        return int(df.iloc[0]["id"]), None if pd.isna(watermark) else watermark
+
+    def stored_analysis_details(self, analysis_id: int) -> tuple:
+        params = (int(analysis_id),)
+        texts = self._read_sql(f"""
+            SELECT [main_profile_text], [career_text], [weak_directions_text], [worsening_subjects_text]
+            FROM {self.schema}[student_analysis]
+            WHERE [id] = ?
+        """, params=params)
+        directions = self._read_sql(f"""
+            SELECT [direction_name], [avg_score], [hist_level], [forecast_score], [forecast_level], [tests_count]
+            FROM {self.schema}[student_analysis_direction]
+            WHERE [analysis_id] = ?
+            ORDER BY [id]
+        """, params=params)
+        weak_topics = self._read_sql(f"""
+            SELECT [direction_name], [subject_name], [topic_name], [topic_score]
+            FROM {self.schema}[student_analysis_weak_topics]
+            WHERE [analysis_id] = ?
+            ORDER BY [id]
+        """, params=params)
+        return tuple(None if pd.isna(t) else t for t in texts.iloc[0]), directions, weak_topics
+
+
+_MSSQL_ENGINE_LOCK = threading.Lock()
+
+
+class MssqlRepository(SqlEduTestRepository):
+    """
+    Робоча EduTestDB на SQL Server. Engine SQLAlchemy створюється
+    при першому читанні, а не під час імпорту модуля.
+    """
 
-# ============================================================
-# 3. Трендове прогнозування по останніх оцінках (по напрямку)
-# ============================================================
+    schema = "[EduTestDB].[dbo]."
+    top_one = "TOP 1 "
+
+    def __init__(self, connection_string: str = None):
+        self.connection_string = connection_string or RAW_CONNECTION_STRING
+        self._engine = None
+        self._analysis_tables_ready = False
+
+    @property
+    def engine(self):
+        # Запити з fetch_concurrently можуть прийти сюди одночасно: engine (і його пул) — один
+        with _MSSQL_ENGINE_LOCK:
+            if self._engine is None:
+                from sqlalchemy import create_engine
+
+                quoted_params = urllib.parse.quote_plus(self.connection_string)
+                self._engine = create_engine(f"mssql+pyodbc:///?odbc_connect={quoted_params}")
+        return self._engine
+
+    @contextmanager
+    def _connectable(self):
+        yield self.engine
+
+    def connect(self):
+        """
+        Підключення для запису результатів. pyodbc бере його з пулу ODBC
+        (pyodbc.pooling увімкнено за замовчуванням), транзакцію фіксує викликач.
+        """
+        import pyodbc
+
+        return pyodbc.connect(self.connection_string, autocommit=False)
+
+    def save_analyses(self, results: list[dict]) -> list[int]:
+        """
+        Одна транзакція на одному підключенні: MERGE для student_analysis
+        та fast_executemany для напрямків і слабких тем.
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.fast_executemany = True
 
-def forecast_direction_score(df_dir: pd.DataFrame) -> float:
+        try:
+            self._ensure_analysis_tables()
+            analysis_ids = upsert_student_analyses(cursor, results)
+            replace_analysis_details(cursor, analysis_ids, results)
+            cursor.execute("DROP TABLE #analysis_batch; DROP TABLE #analysis_ids;")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        return analysis_ids
+
+    def _execute(self, sql: str, params=()):
+        conn = self.connect()
+        try:
+            conn.cursor().execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _ensure_analysis_tables(self):
+        # Той самий ідемпотентний ALTER, що й у database/MSSQL/schema.sql,
+        # щоб база, створена до появи колонки, не ламала аналіз
+        if self._analysis_tables_ready:
+            return
+        self._execute("""
+            IF COL_LENGTH(N'dbo.student_analysis', N'source_watermark') IS NULL
+                ALTER TABLE dbo.student_analysis ADD source_watermark NVARCHAR(200) NULL;
+        """)
+        self._analysis_tables_ready = True
+
+    def touch_analysis(self, analysis_id: int):
+        self._execute(
+            "UPDATE dbo.student_analysis SET generated_at = SYSDATETIME() WHERE id = ?;",
+            (int(analysis_id),),
+        )
+
+    def __getstate__(self):
+        # Engine з пулом підключень не передається в інші процеси (spawn у Windows)
+        return {**self.__dict__, "_engine": None}
+
+    def for_worker(self):
+        return MssqlRepository(self.connection_string)
+
+
+SQLITE_ANALYSIS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS student_analysis (
+        id INTEGER PRIMARY KEY,
+        student_id INTEGER NOT NULL,
+        scope TEXT NOT NULL,
+        class_id INTEGER NULL,
+        generated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        main_profile_text TEXT NULL,
+        career_text TEXT NULL,
+        weak_directions_text TEXT NULL,
+        worsening_subjects_text TEXT NULL,
+        source_watermark TEXT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_student_analysis_student
+        ON student_analysis (student_id, scope, class_id);
+    CREATE TABLE IF NOT EXISTS student_analysis_direction (
+        id INTEGER PRIMARY KEY,
+        analysis_id INTEGER NOT NULL,
+        direction_name TEXT NOT NULL,
+        avg_score REAL NOT NULL,
+        hist_level INTEGER NOT NULL,
+        forecast_score REAL NOT NULL,
+        forecast_level INTEGER NOT NULL,
+        tests_count INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_student_analysis_direction_analysis
+        ON student_analysis_direction (analysis_id);
+    CREATE TABLE IF NOT EXISTS student_analysis_weak_topics (
+        id INTEGER PRIMARY KEY,
+        analysis_id INTEGER NOT NULL,
+        direction_name TEXT NOT NULL,
+        subject_name TEXT NOT NULL,
+        topic_name TEXT NOT NULL,
+        topic_score REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_student_analysis_weak_topics_analysis
+        ON student_analysis_weak_topics (analysis_id);
+"""
+
+
+class SqliteRepository(SqlEduTestRepository):
     """
-    Прогнозована ОЦІНКА для НАПРЯМКУ з урахуванням останніх оцінок.
-    - базово: експоненційно зважене середнє по балах (останні важать більше);
-    - якщо останні оцінки помітно нижчі/вищі за попередні — коригуємо на ±0.5.
+    Локальна копія EduTestDB у файлі SQLite (ті самі таблиці й колонки,
+    без схеми dbo) — для офлайн-аналітики на експорті без SQL Server.
+    Дати зберігаються текстом 'YYYY-MM-DD HH:MM:SS'. Таблиці результатів
+    аналізу створюються при першому збереженні.
     """
-    df_dir = df_dir.sort_values("date_time_taken")
-    scores = df_dir["score"].to_numpy(dtype=float)
-    n = len(df_dir)
 
-    if n == 0:
-        return 0.0
-    if n <= 2:
-        return float(np.mean(scores))
+    limit_one = " LIMIT 1"
 
-    alpha = 0.6
-    weights = np.array([alpha ** (n - 1 - i) for i in range(n)], dtype=float)
-    base_score = float(np.sum(scores * weights) / np.sum(weights))
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        digest = hashlib.sha1(self.path.encode("utf-8")).hexdigest()[:12]
+        self.cache_name = f"sqlite-{digest}"
 
-    if n >= 4:
-        tail = min(4, n // 2)
-        prev_scores = scores[:-tail]
-        last_scores = scores[-tail:]
+    def _connect(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"SQLite-файл джерела даних не знайдено: {self.path}")
+        return sqlite3.connect(self.path)
 
-        if len(prev_scores) >= 3:
-            prev_mean = float(np.mean(prev_scores))
-            last_mean = float(np.mean(last_scores))
+    @contextmanager
+    def _connectable(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _param(self, value):
+        return pd.Timestamp(value).strftime("%Y-%m-%d %H:%M:%S")
+
+    def _ensure_analysis_tables(self):
+        with self._connectable() as conn:
+            conn.executescript(SQLITE_ANALYSIS_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(student_analysis)")}
+            if "source_watermark" not in columns:
+                conn.execute("ALTER TABLE student_analysis ADD COLUMN source_watermark TEXT NULL")
+                conn.commit()
+
+    def touch_analysis(self, analysis_id: int):
+        with self._connectable() as conn:
+            conn.execute("UPDATE student_analysis SET generated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                         (int(analysis_id),))
+            conn.commit()
+
+    def save_analyses(self, results: list[dict]) -> list[int]:
+        self._ensure_analysis_tables()
+
+        conn = self._connect()
+        try:
+            with conn:  # одна транзакція: commit або rollback
+
+                analysis_ids = []
+                for r in results:
+                    student_id = int(r["student_id"])
+                    class_id = None if r["class_id"] is None else int(r["class_id"])
+                    texts = split_recommendation_texts(r["recommendations"])
+                    watermark = r.get("source_watermark")
+
+                    # Той самий ключ, що й у MERGE: (student_id, 'all') або (student_id, 'current_class', class_id)
+                    row = conn.execute("""
+                        SELECT id FROM student_analysis
+                        WHERE student_id = ? AND scope = ? AND (scope = 'all' OR class_id = ?)
+                    """, (student_id, r["scope"], class_id)).fetchone()
+
+                    if row is not None:
+                        conn.execute("""
+                            UPDATE student_analysis
+                            SET class_id = ?, generated_at = CURRENT_TIMESTAMP,
+                                main_profile_text = ?, career_text = ?,
+                                weak_directions_text = ?, worsening_subjects_text = ?,
+                                source_watermark = ?
+                            WHERE id = ?
+                        """, (class_id, *texts, watermark, row[0]))
+                        analysis_ids.append(row[0])
+                    else:
+                        cursor = conn.execute("""
+                            INSERT INTO student_analysis(
+                                student_id, scope, class_id,
+                                main_profile_text, career_text,
+                                weak_directions_text, worsening_subjects_text,
+                                source_watermark
+                            )
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        """, (student_id, r["scope"], class_id, *texts, watermark))
+                        analysis_ids.append(cursor.lastrowid)
+
+                conn.executemany("DELETE FROM student_analysis_direction WHERE analysis_id = ?",
+                                 [(i,) for i in analysis_ids])
+                conn.executemany("DELETE FROM student_analysis_weak_topics WHERE analysis_id = ?",
+                                 [(i,) for i in analysis_ids])
+
+                direction_rows, weak_topic_rows = analysis_detail_rows(analysis_ids, results)
+                conn.executemany(INSERT_ANALYSIS_DIRECTION_SQL.format(schema=""), direction_rows)
+                conn.executemany(INSERT_ANALYSIS_WEAK_TOPIC_SQL.format(schema=""), weak_topic_rows)
+        finally:
+            conn.close()
+
+        return analysis_ids
+
+    def for_worker(self):
+        return SqliteRepository(self.path)
+
+
+_REPOSITORY = None
+
+
+def make_repository(source: str) -> EduTestRepository:
+    """'mssql' або 'sqlite:<шлях>' → репозиторій."""
+    if source == "mssql":
+        return MssqlRepository()
+    if source.startswith("sqlite:"):
+        return SqliteRepository(source[len("sqlite:"):])
+    raise ValueError(f"Невідоме джерело даних: {source!r} (очікується 'mssql' або 'sqlite:<шлях>')")
+
+
+def use_repository(repository: EduTestRepository):
+    """
+    Робить repository джерелом даних модуля. Для джерел з cache_name
+    знімок, модель і словник тем зберігаються в окремій підтеці CACHE_DIR.
+    """
+    global _REPOSITORY, SCORES_SNAPSHOT_PATH, MODEL_STORE_PATH, TOPIC_DICTIONARY_PATH
+    _REPOSITORY = repository
 
-            if last_mean <= prev_mean - 1.0:
-                base_score -= 0.5
-            elif last_mean >= prev_mean + 1.0:
-                base_score += 0.5
+    cache_dir = CACHE_DIR if repository.cache_name is None else os.path.join(CACHE_DIR, repository.cache_name)
+    SCORES_SNAPSHOT_PATH = os.path.join(cache_dir, os.path.basename(SCORES_SNAPSHOT_PATH))
+    MODEL_STORE_PATH = os.path.join(cache_dir, os.path.basename(MODEL_STORE_PATH))
+    TOPIC_DICTIONARY_PATH = os.path.join(cache_dir, os.path.basename(TOPIC_DICTIONARY_PATH))
 
-    base_score = max(1.0, min(12.0, base_score))
-    return base_score
+
+def get_repository() -> EduTestRepository:
+    if _REPOSITORY is None:
+        use_repository(make_repository(DATA_SOURCE))
+    return _REPOSITORY
 
 
 # ============================================================
-# 3.1. Пошук предметів із явно погіршеною динамікою
+# 1.2. Локальний знімок результатів (Arrow) з інкрементальним оновленням
 # ============================================================
 
-def find_worsening_subjects(df: pd.DataFrame) -> list[str]:
-    worsening: list[str] = []
+SCORES_SNAPSHOT_PATH = os.path.join(CACHE_DIR, "student_test_snapshot.arrow")
 
-    for subject, part in df.groupby("subject_name"):
-        part = part.sort_values("date_time_taken")
-        scores = part["score"].to_numpy(dtype=float)
-        n = len(scores)
+USE_SCORES_SNAPSHOT = True  # вимикається ключем --no-snapshot
 
-        if n < 5:
-            continue
 
-        tail = min(4, n // 2)
-        prev_scores = scores[:-tail]
-        last_scores = scores[-tail:]
+def _read_scores_snapshot():
+    import pyarrow.feather as feather
 
-        if len(prev_scores) < 3:
-            continue
+    if not os.path.exists(SCORES_SNAPSHOT_PATH):
+        return None
 
-        prev_mean = float(np.mean(prev_scores))
-        last_mean = float(np.mean(last_scores))
+    # Нестиснений Arrow IPC читається через memory map, без парсингу
+    table = feather.read_table(SCORES_SNAPSHOT_PATH, memory_map=True)
+    return table.to_pandas()
 
-        if last_mean <= prev_mean - 0.5:
-            worsening.append(subject)
 
-    return sorted(set(worsening))
+def _write_scores_snapshot(df: pd.DataFrame):
+    import pyarrow.feather as feather
 
+    os.makedirs(os.path.dirname(SCORES_SNAPSHOT_PATH), exist_ok=True)
+    tmp_path = SCORES_SNAPSHOT_PATH + ".tmp"
+    feather.write_feather(df, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, SCORES_SNAPSHOT_PATH)
 
-# ============================================================
-# 4. Рекомендації по напрямках і темах
-# ============================================================
 
-def generate_direction_and_topic_recommendations(df_student_pred: pd.DataFrame):
+@timed_stage("db")
+def load_all_scores_cached() -> pd.DataFrame:
     """
-    Формує статистику по напрямках і рекомендації.
-    Тепер додано:
-      🆕 Найслабші теми по ВСІХ предметах.
-      🆕 Ігнорування предметів, якщо найслабша тема має високий рівень (10–12).
+    Те саме, що load_all_scores, але через локальний знімок:
+      1) читаємо знімок з диска;
+      2) дочитуємо з БД лише рядки з date_time_taken >= останнього в знімку
+         (рядки з тим самим student_test.id замінюються новими);
+      3) якщо кількість рядків або сума балів не збігається з БД (видалені
+         тести, дооцінені відкриті питання тощо) — повне перезавантаження.
+    Без pyarrow або з --no-snapshot працює як load_all_scores.
     """
-    df = df_student_pred.copy()
-    df["direction"] = df["subject_id"].apply(detect_direction)
+    if not USE_SCORES_SNAPSHOT:
+        return load_all_scores()
+
+    try:
+        snapshot = _read_scores_snapshot()
+    except ImportError:
+        return load_all_scores()
+
+    df = None
+    changed = True
+
+    if snapshot is not None and not snapshot.empty:
+        watermark = snapshot["date_time_taken"].max()
+
+        if not pd.isna(watermark):
+            delta = get_repository().read_scores(taken_from=watermark)
+            # Рядки на самій межі watermark повертаються щоразу —
+            # новими вважаємо лише ті, яких у знімку ще немає в такому вигляді
+            known = snapshot.set_index("student_test_id").reindex(delta["student_test_id"])
+            is_new = ~(
+                (known["date_time_taken"].to_numpy() == delta["date_time_taken"].to_numpy())
+                & (known["score"].to_numpy() == delta["score"].to_numpy())
+            )
+            print(f"DEBUG: знімок: {len(snapshot)} рядків, нових/змінених з БД: {int(is_new.sum())}")
 
-    # ============================================================
-    # 1. Статистика по темах
-    # ============================================================
-    topic_stats = (
-        df.groupby(["direction", "subject_name", "topic"])
-          .agg(avg_score=("score", "mean"), tests_count=("score", "count"))
-          .reset_index()
-    )
-    topic_stats["avg_score"] = topic_stats["avg_score"].round(2)
+            if not is_new.any():
+                df = snapshot
+                changed = False
+            else:
+                df = compact_scores_frame(pd.concat([
+                    snapshot[~snapshot["student_test_id"].isin(delta["student_test_id"])],
+                    delta,
+                ], ignore_index=True))
 
-    # ============================================================
-    # 2. Статистика по напрямках
-    # ============================================================
-    dir_stats = (
-        df.groupby("direction")
-          .agg(
-              avg_score=("score", "mean"),
-              avg_level=("predicted_level", "mean"),
-              tests_count=("score", "count")
-          )
-          .reset_index()
-    )
-    dir_stats["avg_score"] = dir_stats["avg_score"].round(2)
-    dir_stats["avg_level"] = dir_stats["avg_level"].round(2)
+            # Дооцінене відкрите питання змінює бал старого рядка без зміни
+            # дати, тож його видно лише за сумою балів
+            expected_count, _, expected_sum = load_scores_watermark()
+            score_sum = float(df["score"].sum())
+            if len(df) != expected_count or not math.isclose(score_sum, expected_sum, rel_tol=1e-9, abs_tol=1e-4):
+                print(f"DEBUG: знімок розійшовся з БД ({len(df)} рядків, сума {score_sum} "
+                      f"проти {expected_count}, {expected_sum}), повне перезавантаження")
+                df = None
+                changed = True
 
-    # Для зручності список предметів у кожному напрямку
-    subjects_per_direction = (
-        df.groupby("direction")["subject_name"]
-          .apply(lambda s: sorted(set(s)))
-          .to_dict()
-    )
+    if df is None:
+        df = get_repository().read_scores()
 
-    # ============================================================
-    # 3. Формуємо прогноз для кожного напрямку
-    # ============================================================
-    forecast_info = []
+    if changed:
+        _write_scores_snapshot(df)
 
-    for _, row in dir_stats.iterrows():
-        direction = row["direction"]
-        avg_score = float(row["avg_score"])
-        avg_level_num = float(row["avg_level"])
-        tests_count = int(row["tests_count"])
+    return analysis_frame(add_topics(df))
 
-        hist_level_int = int(round(avg_level_num))
-        hist_level_text = level_to_name(hist_level_int)
 
-        df_dir = df[df["direction"] == direction]
-        forecast_score = forecast_direction_score(df_dir)
-        forecast_level_int = score_to_level(forecast_score)
-        forecast_level_display = format_forecast_level(forecast_score)
+# ============================================================
+# 1.1. Період поточного класу (через student + student_class_history)
+# ============================================================
 
-        forecast_info.append({
-            "direction": direction,
-            "avg_score": avg_score,
-            "hist_level": hist_level_text,
-            "hist_level_num": hist_level_int,
-            "forecast_score": round(forecast_score, 2),
+@timed_stage("db")
+def get_current_class_period(student_id: int):
+    """
+    Визначає період поточного класу студента одним запитом
+    (student LEFT JOIN student_class_history):
+      1) current_class_id з таблиці student;
+      2) останній запис у student_class_history для цього class_id;
+      3) повертаємо (class_id, date_from, date_to).
+    Якщо date_to = NULL, вважаємо верхню межу 9999-12-31.
+    Якщо щось не знайшли — повертаємо (None, None, None).
+    """
+    return get_repository().current_class_period(student_id)
+
+
+@timed_stage("db")
+def load_class_periods(student_ids=None) -> pd.DataFrame:
+    """
+    Періоди поточного класу багатьох учнів одним запитом (як
+    get_current_class_period для кожного): індекс student_id, колонки
+    class_id (<NA> — класу немає), date_from (NaT — періоду немає) і
+    date_to (NaT — без верхньої межі). Учнів, яких немає в student, немає й тут.
+    """
+    if student_ids is not None:
+        student_ids = [int(i) for i in student_ids]
+        if not student_ids:
+            return pd.DataFrame(
+                {"class_id": pd.Series(dtype="Int64"),
+                 "date_from": pd.Series(dtype="datetime64[ns]"),
+                 "date_to": pd.Series(dtype="datetime64[ns]")},
+                index=pd.Index([], name="student_id"),
+            )
+
+    df = get_repository().current_class_periods(student_ids)
+    has_history = df["history_student_id"].notna()
+    return pd.DataFrame({
+        "class_id": df["class_id"].astype("Int64"),
+        "date_from": df["date_from"].where(has_history),
+        "date_to": df["date_to"].where(has_history),
+    }).set_axis(pd.Index(df["student_id"].astype(np.int64), name="student_id"))
+
+
+def filter_current_class_bulk(df_students: pd.DataFrame, periods: pd.DataFrame) -> pd.DataFrame:
+    """
+    filter_by_period для кожного учня за його періодом з load_class_periods —
+    одне векторне порівняння по всій таблиці; учні без класу чи періоду
+    не фільтруються (як у filter_student_scope).
+    """
+    student_ids = df_students["student_id"].astype(np.int64)
+    date_from = student_ids.map(periods["date_from"])
+    date_to = student_ids.map(periods["date_to"])
+    taken = df_students["date_time_taken"]
+
+    keep = date_from.isna() | ((taken >= date_from) & (date_to.isna() | (taken <= date_to)))
+    return df_students[keep.to_numpy()]
+
+
+def filter_student_scope(df_student: pd.DataFrame, student_id: int, scope: str,
+                         period=None) -> pd.DataFrame:
+    """
+    period — уже отриманий (class_id, date_from, date_to); якщо None,
+    період читається з БД через get_current_class_period.
+    """
+    df = df_student.copy()
+
+    if scope == "all":
+        return df
+
+    if scope == "current_class":
+        if period is None:
+            period = get_current_class_period(student_id)
+        class_id, date_from, date_to = period
+
+        if class_id is None or date_from is None:
+            return df
+
+        return filter_by_period(df, date_from, date_to)
+
+    return df
+
+
+def filter_by_period(df: pd.DataFrame, date_from, date_to) -> pd.DataFrame:
+    mask = (
+        df["date_time_taken"] >= pd.to_datetime(date_from)
+    ) & (
+        df["date_time_taken"] <= pd.to_datetime(date_to)
+    )
+    return df[mask]
+
+
+# ============================================================
+# 1.2. Незалежні запити до БД — одночасно
+# ============================================================
+
+DB_FETCH_WORKERS = 4  # разом з потоком викликача — розмір пулу engine SQLAlchemy (5)
+
+_db_fetch_pool = None
+_db_fetch_pool_lock = threading.Lock()
+
+
+def _fetch_pool() -> ThreadPoolExecutor:
+    global _db_fetch_pool
+    with _db_fetch_pool_lock:
+        if _db_fetch_pool is None:
+            _db_fetch_pool = ThreadPoolExecutor(max_workers=DB_FETCH_WORKERS, thread_name_prefix="db-fetch")
+        return _db_fetch_pool
+
+
+def fetch_concurrently(*calls) -> list:
+    """
+    Виконує незалежні читання calls (функції без аргументів) одночасно,
+    кожне на своєму підключенні (пул engine для SQL Server, окреме
+    підключення SQLite), і повертає результати в порядку calls: очікування
+    БД — найдовший запит, а не сума. Перший виклик іде в поточному потоці;
+    виняток будь-якого з них передається викликачу.
+    """
+    with stage("fetch_concurrently", "db"):
+        # Етапи з потоків пулу — вкладені в цей, тож час БД не рахується двічі
+        parent_stack = list(getattr(_stage_local, "stack", None) or [])
+
+        def run(call):
+            _stage_local.stack = list(parent_stack)
+            try:
+                return call()
+            finally:
+                _stage_local.stack = []
+
+        futures = [_fetch_pool().submit(run, call) for call in calls[1:]]
+        results = [calls[0]()]
+        results.extend(future.result() for future in futures)
+    return results
+
+
+# ============================================================
+# 2. Навчання глобальної ML-моделі
+# ============================================================
+
+MODEL_FEATURES = ["score", "subject_id", "topic_id"]
+
+
+def _fit_level_model(X: pd.DataFrame, sample_weight=None):
+    # sklearn імпортується лише тут: аналіз зі збереженою моделлю його не потребує
+    from sklearn.preprocessing import MinMaxScaler
+    from sklearn.tree import DecisionTreeClassifier
+
+    y = X["score"].apply(score_to_level)
+
+    scaler = MinMaxScaler()
+    X_scaled = scaler.fit_transform(X)
+
+    model = DecisionTreeClassifier(
+        criterion="gini",
+        max_depth=6,
+        random_state=42
+    )
+    model.fit(X_scaled, y, sample_weight=sample_weight)
+
+    return model, scaler
+
+
+# Більше рядків get_global_model не навчає порядково: повне перенавчання
+# йде лише зі статистики training_counts (та сама модель за O(клітинок))
+MODEL_TRAIN_BUDGET_ROWS = 500_000
+
+
+@timed_stage("training")
+def train_global_model(df_all: pd.DataFrame):
+    """Повне навчання на всіх рядках df_all."""
+    return _fit_level_model(df_all[MODEL_FEATURES])
+
+
+@timed_stage("training")
+def train_global_model_from_counts(counts: pd.DataFrame):
+    """
+    Навчання на статистиці training_counts: рівень — функція балу, тож дерево
+    на унікальних (score, subject_id, topic_id) з вагою count таке саме, як
+    на всіх рядках (ті самі зважені gini, ті самі пороги), а MinMaxScaler
+    бачить ті самі min/max.
+    """
+    model, scaler = _fit_level_model(counts[MODEL_FEATURES], sample_weight=counts["count"].to_numpy(dtype=np.float64))
+    _weight_missing_go_to_left(model, scaler.transform(counts[MODEL_FEATURES]))
+    return model, scaler
+
+
+def _weight_missing_go_to_left(model, X: np.ndarray):
+    """
+    Вузлам, у які при навчанні не дійшов NaN їхньої ознаки, sklearn
+    ставить missing_go_to_left за кількістю зразків (n_left > n_right).
+    На статистиці зразок — клітинка, а не рядок, тож напрям береться з
+    ваг дітей (кількості рядків), як у повному навчанні.
+    """
+    tree = model.tree_
+    state = tree.__getstate__()
+    nodes = state["nodes"]
+
+    path = model.decision_path(X).tocoo()
+    internal = tree.children_left[path.col] != -1
+    rows, node = path.row[internal], path.col[internal]
+    saw_missing = np.zeros(tree.node_count, dtype=bool)
+    saw_missing[node[np.isnan(X[rows, tree.feature[node]])]] = True
+
+    weights = nodes["weighted_n_node_samples"]
+    fix = np.flatnonzero((nodes["left_child"] != -1) & ~saw_missing)
+    nodes["missing_go_to_left"][fix] = weights[nodes["left_child"][fix]] > weights[nodes["right_child"][fix]]
+    tree.__setstate__(state)
+
+
+# ============================================================
+# 2.1. Модель без sklearn: масиви навченого дерева і масштабування
+# ============================================================
+
+class CompiledScaler:
+    """MinMaxScaler.transform без sklearn: X * scale + min (у float64, як sklearn)."""
+
+    def __init__(self, min_: np.ndarray, scale: np.ndarray):
+        self.min_ = np.asarray(min_, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+
+    @classmethod
+    def from_sklearn(cls, scaler):
+        return cls(scaler.min_, scaler.scale_)
+
+    def to_state(self) -> dict:
+        return {"min": self.min_, "scale": self.scale}
+
+    @classmethod
+    def from_state(cls, state: dict):
+        return cls(state["min"], state["scale"])
+
+    def transform(self, X) -> np.ndarray:
+        X = np.array(X, dtype=np.float64)
+        X *= self.scale
+        X += self.min_
+        return X
+
+
+class CompiledTree:
+    """
+    DecisionTreeClassifier.predict без sklearn: спуск по масивах tree_
+    для всіх рядків одночасно. Як і sklearn, ознаки порівнюються у float32,
+    а NaN (NULL бал) іде у гілку missing_go_to_left вузла.
+    """
+
+    def __init__(self, children_left, children_right, feature, threshold, leaf_class, missing_go_to_left):
+        self.children_left = np.asarray(children_left, dtype=np.intp)
+        self.children_right = np.asarray(children_right, dtype=np.intp)
+        self.feature = np.asarray(feature, dtype=np.intp)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.leaf_class = np.asarray(leaf_class)
+        self.missing_go_to_left = np.asarray(missing_go_to_left, dtype=bool)
+        self.table = None  # PredictionTable, не входить у to_state
+
+    @classmethod
+    def from_sklearn(cls, model):
+        tree = model.tree_
+        # Клас вузла — як у predict: перший з максимальною вагою
+        leaf_class = model.classes_[np.argmax(tree.value[:, 0, :], axis=1)]
+        return cls(tree.children_left, tree.children_right, tree.feature, tree.threshold, leaf_class,
+                   tree.missing_go_to_left)
+
+    def to_state(self) -> dict:
+        return {
+            "children_left": self.children_left,
+            "children_right": self.children_right,
+            "feature": self.feature,
+            "threshold": self.threshold,
+            "leaf_class": self.leaf_class,
+            "missing_go_to_left": self.missing_go_to_left,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict):
+        return cls(**state)
+
+    def predict(self, X) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float32)
+        node = np.zeros(len(X), dtype=np.intp)
+        active = np.flatnonzero(self.children_left[node] != -1)
+
+        while len(active):
+            n = node[active]
+            x = X[active, self.feature[n]]
+            go_left = np.where(np.isnan(x), self.missing_go_to_left[n], x <= self.threshold[n])
+            node[active] = np.where(go_left, self.children_left[n], self.children_right[n])
+            active = active[self.children_left[node[active]] != -1]
+
+        return self.leaf_class[node]
+
+
+class PredictionTable:
+    """
+    predicted_level для всіх цілих (score, subject_id, topic_id) у межах
+    0..max_score × 0..max_subject × 0..max_topic, обчислений деревом один раз.
+    Прогноз — один numpy-індекс без масштабування і спуску по дереву;
+    рядки поза таблицею (дробовий бал, id поза межами) рахує дерево.
+    """
+
+    MAX_CELLS = 20_000_000  # int8-таблиця до ~20 МБ
+
+    def __init__(self, codes: np.ndarray, classes: np.ndarray):
+        self.codes = np.asarray(codes, dtype=np.int8)
+        self.classes = np.asarray(classes)
+
+    @classmethod
+    def compile(cls, model: "CompiledTree", scaler: CompiledScaler,
+                max_score: int, max_subject: int, max_topic: int):
+        """Таблиця для model/scaler або None, якщо вона завелика."""
+        shape = (int(max_score) + 1, int(max_subject) + 1, int(max_topic) + 1)
+        if min(shape) < 1 or np.prod(shape, dtype=np.int64) > cls.MAX_CELLS:
+            return None
+
+        grid = np.indices(shape).reshape(3, -1).T
+        levels = model.predict(scaler.transform(grid))
+        classes, codes = np.unique(levels, return_inverse=True)
+        return cls(codes.reshape(shape), classes)
+
+    def to_state(self) -> dict:
+        return {"codes": self.codes, "classes": self.classes}
+
+    @classmethod
+    def from_state(cls, state: dict):
+        return cls(state["codes"], state["classes"])
+
+    def lookup(self, score: np.ndarray, subject_id: np.ndarray, topic_id: np.ndarray):
+        """(рівні, маска рядків, знайдених у таблиці); поза маскою рівні не визначені."""
+        score = np.asarray(score, dtype=np.float64)
+        # NaN (NULL бал) не в таблиці: індекс 0 замість невизначеного приведення,
+        # а маска нижче (score_idx != score) віддає такі рядки дереву
+        score_idx = np.where(np.isnan(score), 0, score).astype(np.intp)
+        subject_id = np.asarray(subject_id).astype(np.intp, copy=False)
+        topic_id = np.asarray(topic_id).astype(np.intp, copy=False)
+
+        shape = self.codes.shape
+        if len(score) and all(
+            idx.min() >= 0 and idx.max() < n
+            for idx, n in zip((score_idx, subject_id, topic_id), shape)
+        ) and np.array_equal(score_idx, score):
+            # Звичайний випадок: усі рядки в таблиці, один take по плоскому індексу
+            hit = np.ones(len(score), dtype=bool)
+        else:
+            hit = score_idx == score
+            for idx, n in zip((score_idx, subject_id, topic_id), shape):
+                hit &= (idx >= 0) & (idx < n)
+            score_idx, subject_id, topic_id = (np.where(hit, idx, 0) for idx in (score_idx, subject_id, topic_id))
+
+        flat = (score_idx * shape[1] + subject_id) * shape[2] + topic_id
+        return self.classes[self.codes.ravel().take(flat)], hit
+
+
+def compile_model(model, scaler):
+    """(CompiledTree, CompiledScaler) з навчених sklearn-обʼєктів."""
+    return CompiledTree.from_sklearn(model), CompiledScaler.from_sklearn(scaler)
+
+
+def compile_prediction_table(model: CompiledTree, scaler: CompiledScaler, df_all: pd.DataFrame):
+    """Прикріплює до model таблицю прогнозу (model.table) для меж даних df_all."""
+    model.table = PredictionTable.compile(
+        model, scaler,
+        max(12, int(np.ceil(df_all["score"].max()))),
+        int(df_all["subject_id"].max()),
+        int(df_all["topic_id"].max()),
+    )
+    return model
+
+
+# ============================================================
+# 2.2. Збережена модель (перенавчання лише при зміні даних)
+# ============================================================
+
+MODEL_STORE_PATH = os.path.join(CACHE_DIR, "global_model.pkl")
+
+FORCE_RETRAIN = False  # вмикається ключем --retrain
+
+# Після стількох інкрементальних оновлень модель навчається на всіх рядках
+# заново і звіряється з інкрементальною
+MODEL_FULL_REFIT_EVERY = 50
+
+
+def topic_ids_of(df_all: pd.DataFrame) -> dict:
+    """{тема: topic_id} для тем, що є в даних."""
+    pairs = df_all.drop_duplicates("topic_id")[["topic", "topic_id"]]
+    return dict(zip(pairs["topic"].astype(object).tolist(), pairs["topic_id"].astype(int).tolist()))
+
+
+def training_data_fingerprint(df_all: pd.DataFrame) -> dict:
+    """
+    Відбиток навчальних даних: кількість рядків, останній date_time_taken
+    та факторизація тем (порядок topic → topic_id).
+    """
+    topics = [f"{topic_id}:{topic}" for topic, topic_id in sorted(topic_ids_of(df_all).items(), key=lambda p: p[1])]
+    return {
+        "rows": int(len(df_all)),
+        "max_date_time_taken": str(df_all["date_time_taken"].max()),
+        "topics_sha256": hashlib.sha256("\n".join(topics).encode("utf-8")).hexdigest(),
+    }
+
+
+def training_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Кількість рядків на кожне (score, subject_id, topic_id). Рядки з NULL
+    балом теж рахуються (окремою клітинкою), як їх бачить і повне навчання.
+    """
+    return (
+        df.groupby(MODEL_FEATURES, observed=True, sort=True, dropna=False)
+          .size()
+          .rename("count")
+          .reset_index()
+    )
+
+
+def merge_training_counts(counts: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+    return (
+        pd.concat([counts, delta], ignore_index=True)
+          .groupby(MODEL_FEATURES, sort=True, dropna=False)["count"].sum()
+          .reset_index()
+    )
+
+
+def same_training_counts(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+    return len(a) == len(b) and all(
+        np.array_equal(a[col].to_numpy(dtype=np.float64), b[col].to_numpy(dtype=np.float64), equal_nan=True)
+        for col in MODEL_FEATURES + ["count"]
+    )
+
+
+def training_counts_state(df_all: pd.DataFrame, counts: pd.DataFrame) -> dict:
+    """
+    Статистика для сховища разом з тим, по яких рядках її пораховано:
+    кількість, останній date_time_taken і сума балів.
+    """
+    return {
+        "cells": {col: counts[col].to_numpy() for col in counts.columns},
+        "rows": int(len(df_all)),
+        "max_date_time_taken": df_all["date_time_taken"].max(),
+        "score_sum": float(df_all["score"].astype(np.float64).sum()),
+    }
+
+
+def new_training_rows(df_all: pd.DataFrame, state: dict):
+    """
+    Рядки df_all, додані після підрахунку state (date_time_taken пізніше
+    за останній врахований), або None, якщо старі рядки змінились
+    (інша кількість чи сума балів) і статистику треба рахувати заново.
+    """
+    is_new = (df_all["date_time_taken"] > state["max_date_time_taken"]).to_numpy()
+    # Сума pandas пропускає NULL-бали так само, як і training_counts_state
+    old_scores = df_all["score"].astype(np.float64)[~is_new]
+    if len(old_scores) != state["rows"] or not math.isclose(
+        old_scores.sum(), state["score_sum"], rel_tol=1e-12, abs_tol=1e-9
+    ):
+        return None
+    return df_all[is_new]
+
+
+def _load_model_store():
+    if not os.path.exists(MODEL_STORE_PATH):
+        return None
+    try:
+        with open(MODEL_STORE_PATH, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        # Пошкоджений файл або інша версія sklearn — просто перенавчаємо
+        print(f"DEBUG: не вдалося прочитати збережену модель: {e}")
+        return None
+
+
+def _save_model_store(fingerprint: dict, model: CompiledTree, scaler: CompiledScaler, topics: dict,
+                      counts: dict = None, incremental_fits: int = 0):
+    # Лише словники numpy-масивів: читання сховища не імпортує sklearn
+    os.makedirs(os.path.dirname(MODEL_STORE_PATH), exist_ok=True)
+    tmp_path = MODEL_STORE_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({
+            "fingerprint": fingerprint,
+            "tree": model.to_state(),
+            "scaler": scaler.to_state(),
+            "table": None if model.table is None else model.table.to_state(),
+            "topics": topics,  # {тема: topic_id}, на яких навчалась модель
+            "counts": counts,  # training_counts_state для інкрементального навчання
+            "incremental_fits": incremental_fits,  # оновлень після повного навчання
+        }, f)
+    os.replace(tmp_path, MODEL_STORE_PATH)
+
+
+def _stored_model(stored):
+    """
+    (model, scaler) зі сховища або None для старого формату (з обʼєктами
+    sklearn або дерево без missing_go_to_left).
+    """
+    if stored is None or "missing_go_to_left" not in stored.get("tree", {}):
+        return None
+    model, scaler = CompiledTree.from_state(stored["tree"]), CompiledScaler.from_state(stored["scaler"])
+    if stored.get("table") is not None:
+        model.table = PredictionTable.from_state(stored["table"])
+    return model, scaler
+
+
+@timed_stage("training")
+def get_global_model(df_all: pd.DataFrame, retrain: bool = False):
+    """
+    Повертає (model, scaler) у вигляді CompiledTree/CompiledScaler:
+    зі сховища, якщо відбиток даних не змінився. Якщо додались лише нові
+    проходження, модель донавчається зі збереженої статистики
+    (training_counts) плюс нові рядки; інакше, при retrain і кожні
+    MODEL_FULL_REFIT_EVERY оновлень — навчається заново: на всіх рядках
+    зі звіркою зі статистикою, а понад MODEL_TRAIN_BUDGET_ROWS рядків —
+    лише зі свіжої статистики (час і памʼять навчання не ростуть з історією).
+    """
+    fingerprint = training_data_fingerprint(df_all)
+    stored = None if retrain else _load_model_store()
+
+    compiled = _stored_model(stored)
+    if compiled is not None and stored.get("fingerprint") == fingerprint:
+        print("DEBUG: використовуємо збережену модель")
+        if compiled[0].table is None:
+            compile_prediction_table(*compiled, df_all)
+        return compiled
+
+    counts = None
+    incremental_fits = 0
+    if compiled is not None and stored.get("counts") is not None:
+        new_rows = new_training_rows(df_all, stored["counts"])
+        if new_rows is not None:
+            counts = merge_training_counts(pd.DataFrame(stored["counts"]["cells"]), training_counts(new_rows))
+            incremental_fits = stored.get("incremental_fits", 0) + 1
+            print(f"DEBUG: інкрементальне оновлення статистики: +{len(new_rows)} рядків")
+
+    if counts is not None and incremental_fits < MODEL_FULL_REFIT_EVERY:
+        print("DEBUG: навчання глобальної моделі зі статистики")
+        model, scaler = compile_model(*train_global_model_from_counts(counts))
+    else:
+        print("DEBUG: навчання глобальної моделі")
+        full_counts = training_counts(df_all)
+        if counts is not None:
+            if same_training_counts(counts, full_counts):
+                print("DEBUG: інкрементальна статистика збігається з повним підрахунком")
+            else:
+                print("УВАГА: інкрементальна статистика відрізняється від повного підрахунку")
+
+        if len(df_all) <= MODEL_TRAIN_BUDGET_ROWS:
+            # Порядкове навчання — еталон, з яким звіряється модель зі статистики
+            model, scaler = compile_model(*train_global_model(df_all))
+            counts_model, counts_scaler = compile_model(*train_global_model_from_counts(full_counts))
+            if model_digest(counts_model, counts_scaler) == model_digest(model, scaler):
+                print("DEBUG: модель зі статистики збігається з повністю навченою")
+            else:
+                print("УВАГА: модель зі статистики відрізняється від повністю навченої")
+        else:
+            print(f"DEBUG: {len(df_all)} рядків більше за MODEL_TRAIN_BUDGET_ROWS — навчання лише зі статистики")
+            model, scaler = compile_model(*train_global_model_from_counts(full_counts))
+
+        counts = full_counts
+        incremental_fits = 0
+
+    compile_prediction_table(model, scaler, df_all)
+    _save_model_store(fingerprint, model, scaler, topic_ids_of(df_all),
+                      training_counts_state(df_all, counts), incremental_fits)
+    return model, scaler
+
+
+@timed_stage("recommendations")
+def apply_model_to_student(df_student: pd.DataFrame, model, scaler) -> pd.DataFrame:
+    df = df_student.copy()
+    X = df[MODEL_FEATURES]
+
+    table = getattr(model, "table", None)
+    if table is None:
+        df["predicted_level"] = model.predict(scaler.transform(X))
+        return df
+
+    levels, hit = table.lookup(*(X[col].to_numpy() for col in X.columns))
+    if not hit.all():
+        levels[~hit] = model.predict(scaler.transform(X[~hit]))
+    df["predicted_level"] = levels
+    return df
+
+
+# ============================================================
+# 3. Трендове прогнозування по останніх оцінках (по напрямку)
+# ============================================================
+
+def forecast_direction_score(df_dir: pd.DataFrame) -> float:
+    """
+    Прогнозована ОЦІНКА для НАПРЯМКУ з урахуванням останніх оцінок.
+    - базово: експоненційно зважене середнє по балах (останні важать більше);
+    - якщо останні оцінки помітно нижчі/вищі за попередні — коригуємо на ±0.5.
+    """
+    # Однакові дати лишаються в порядку рядків (як у generate_recommendations_bulk)
+    df_dir = df_dir.sort_values("date_time_taken", kind="stable")
+    scores = df_dir["score"].to_numpy(dtype=float)
+    n = len(df_dir)
+
+    if n == 0:
+        return 0.0
+    if n <= 2:
+        return float(np.mean(scores))
+
+    alpha = 0.6
+    weights = np.array([alpha ** (n - 1 - i) for i in range(n)], dtype=float)
+    base_score = float(np.sum(scores * weights) / np.sum(weights))
+
+    if n >= 4:
+        tail = min(4, n // 2)
+        prev_scores = scores[:-tail]
+        last_scores = scores[-tail:]
+
+        if len(prev_scores) >= 3:
+            prev_mean = float(np.mean(prev_scores))
+            last_mean = float(np.mean(last_scores))
+
+            if last_mean <= prev_mean - 1.0:
+                base_score -= 0.5
+            elif last_mean >= prev_mean + 1.0:
+                base_score += 0.5
+
+    base_score = max(1.0, min(12.0, base_score))
+    return base_score
+
+
+# ============================================================
+# 3.1. Пошук предметів із явно погіршеною динамікою
+# ============================================================
+
+def find_worsening_subjects(df: pd.DataFrame) -> list[str]:
+    worsening: list[str] = []
+
+    for subject, part in df.groupby("subject_name", observed=True):
+        part = part.sort_values("date_time_taken", kind="stable")
+        scores = part["score"].to_numpy(dtype=float)
+        n = len(scores)
+
+        if n < 5:
+            continue
+
+        tail = min(4, n // 2)
+        prev_scores = scores[:-tail]
+        last_scores = scores[-tail:]
+
+        if len(prev_scores) < 3:
+            continue
+
+        prev_mean = float(np.mean(prev_scores))
+        last_mean = float(np.mean(last_scores))
+
+        if last_mean <= prev_mean - 0.5:
+            worsening.append(subject)
+
+    return sorted(set(worsening))
+
+
+# ============================================================
+# 4. Рекомендації по напрямках і темах
+# ============================================================
+
+@timed_stage("recommendations")
+def generate_direction_and_topic_recommendations(df_student_pred: pd.DataFrame):
+    """
+    Формує статистику по напрямках і рекомендації.
+    Тепер додано:
+      🆕 Найслабші теми по ВСІХ предметах.
+      🆕 Ігнорування предметів, якщо найслабша тема має високий рівень (10–12).
+    """
+    df = df_student_pred.copy()
+    df["direction"] = df["subject_id"].apply(detect_direction)
+
+    # ============================================================
+    # 1. Статистика по темах
+    # ============================================================
+    topic_stats = (
+        df.groupby(["direction", "subject_name", "topic"], observed=True)
+          .agg(avg_score=("score", "mean"), tests_count=("score", "count"))
+          .reset_index()
+    )
+    topic_stats["avg_score"] = topic_stats["avg_score"].round(2)
+
+    # ============================================================
+    # 2. Статистика по напрямках
+    # ============================================================
+    dir_stats = (
+        df.groupby("direction")
+          .agg(
+              avg_score=("score", "mean"),
+              avg_level=("predicted_level", "mean"),
+              tests_count=("score", "count")
+          )
+          .reset_index()
+    )
+    dir_stats["avg_score"] = dir_stats["avg_score"].round(2)
+    dir_stats["avg_level"] = dir_stats["avg_level"].round(2)
+
+    # Для зручності список предметів у кожному напрямку
+    subjects_per_direction = (
+        df.groupby("direction")["subject_name"]
+          .apply(lambda s: sorted(set(s)))
+          .to_dict()
+    )
+
+    # ============================================================
+    # 3. Формуємо прогноз для кожного напрямку
+    # ============================================================
+    forecast_info = []
+
+    # Рядки кожного напрямку — за один прохід, а не маскою на кожен напрямок
+    dir_rows = dict(tuple(df.groupby("direction", sort=False)))
+
+    for _, row in dir_stats.iterrows():
+        direction = row["direction"]
+        avg_score = float(row["avg_score"])
+        avg_level_num = float(row["avg_level"])
+        tests_count = int(row["tests_count"])
+
+        hist_level_int = int(round(avg_level_num))
+        hist_level_text = level_to_name(hist_level_int)
+
+        forecast_score = forecast_direction_score(dir_rows[direction])
+        forecast_level_int = score_to_level(forecast_score)
+        forecast_level_display = format_forecast_level(forecast_score)
+
+        forecast_info.append({
+            "direction": direction,
+            "avg_score": avg_score,
+            "hist_level": hist_level_text,
+            "hist_level_num": hist_level_int,
+            "forecast_score": round(forecast_score, 2),
             "forecast_level": level_to_name(forecast_level_int),
             "forecast_level_num": forecast_level_int,
             "forecast_level_display": forecast_level_display,
@@ -532,10 +2124,11 @@ def generate_direction_and_topic_recommendations(df_student_pred: pd.DataFrame):
     # 6. 🆕 Найслабші теми по ВСІХ ПРЕДМЕТАХ (нова логіка)
     # ============================================================
     weak_topics_all_subjects = []
+    topic_subject = df.groupby("topic", observed=True, sort=False)["subject_id"].first()
 
-    for subject, part in df.groupby("subject_name"):
+    for subject, part in df.groupby("subject_name", observed=True):
         topic_means = (
-            part.groupby("topic")["score"]
+            part.groupby("topic", observed=True)["score"]
                 .mean()
                 .reset_index()
         )
@@ -549,256 +2142,763 @@ def generate_direction_and_topic_recommendations(df_student_pred: pd.DataFrame):
 
         for _, trow in worst_topics.iterrows():
             weak_topics_all_subjects.append({
-                "direction": detect_direction(
-                    df[df["topic"] == trow["topic"]]["subject_id"].iloc[0]
-                ),
+                "direction": detect_direction(topic_subject[trow["topic"]]),
+                "subject": subject,
+                "topic": trow["topic"],
+                "score": float(trow["score"]),
+            })
+
+    weak_topics_struct.extend(weak_topics_all_subjects)
+
+    # ============================================================
+    # 7. Погіршення у предметах (стара логіка)
+    # ============================================================
+    worsening_subjects = find_worsening_subjects(df)
+    worsening_text = None
+
+    if worsening_subjects:
+        subj_str = ", ".join(worsening_subjects)
+        worsening_text = (
+            f"Окремо слід звернути увагу на предмет(и): {subj_str}, "
+            f"де в динаміці результатів простежується зниження оцінок."
+        )
+
+    # ============================================================
+    # 8. Формуємо текст рекомендацій
+    # ============================================================
+    recommendations = []
+
+    if primary_direction is not None:
+        recommendations.append(
+            f"Основний освітній профіль: найсильніший напрямок — «{primary_direction}» "
+            f"(середній бал {primary_avg_score}, прогнозований рівень: {primary_forecast_level_display})."
+        )
+        recommendations.append(
+            f"Карʼєрні рекомендації: {CAREER_SUGGESTIONS.get(primary_direction)}."
+        )
+
+    if weak_recommendation_text:
+        recommendations.append(weak_recommendation_text)
+
+    if worsening_text:
+        recommendations.append(worsening_text)
+
+    return forecast_df, recommendations, weak_topics_struct
+
+
+# ============================================================
+# 5. Векторизовані рекомендації для багатьох учнів одночасно
+# ============================================================
+
+_LEVEL_UPPER_BOUNDS = np.array([3.0, 6.0, 9.0])
+
+
+def scores_to_levels(scores) -> np.ndarray:
+    """Векторний аналог score_to_level для масиву балів."""
+    return np.searchsorted(_LEVEL_UPPER_BOUNDS, np.asarray(scores, dtype=float), side="left")
+
+
+@lru_cache(maxsize=None)
+def _ewma_weights(n: int) -> np.ndarray:
+    # Ті самі ваги, що й у forecast_direction_score (побітово)
+    alpha = 0.6
+    return np.array([alpha ** (n - 1 - i) for i in range(n)], dtype=float)
+
+
+def _group_bounds(sizes: np.ndarray):
+    sizes = np.asarray(sizes, dtype=np.int64)
+    starts = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    return starts, sizes
+
+
+def _forecast_scores_bulk(scores_sorted: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    forecast_direction_score для багатьох груп одразу.
+    Групи однакової довжини n збираються в матрицю (k × n), і всі суми
+    рахуються по рядках — це дає ті самі значення, що й np.sum/np.mean
+    для кожної групи окремо, без циклу по групах.
+    """
+    out = np.zeros(len(sizes), dtype=float)
+
+    for n in np.unique(sizes):
+        n = int(n)
+        sel = np.flatnonzero(sizes == n)
+        if n == 0:
+            continue
+
+        m = scores_sorted[starts[sel, None] + np.arange(n)]
+
+        if n <= 2:
+            out[sel] = m.mean(axis=1)
+            continue
+
+        weights = _ewma_weights(n)
+        base = (m * weights).sum(axis=1) / np.sum(weights)
+
+        if n >= 4:
+            tail = min(4, n // 2)
+            if n - tail >= 3:
+                prev_mean = m[:, :-tail].mean(axis=1)
+                last_mean = m[:, -tail:].mean(axis=1)
+                base = np.where(
+                    last_mean <= prev_mean - 1.0, base - 0.5,
+                    np.where(last_mean >= prev_mean + 1.0, base + 0.5, base)
+                )
+
+        # max(1.0, min(12.0, NaN)) у forecast_direction_score дає 12.0, а np.clip лишає NaN
+        out[sel] = np.where(np.isnan(base), 12.0, np.clip(base, 1.0, 12.0))
+
+    return out
+
+
+def _worsening_flags_bulk(scores_sorted: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    find_worsening_subjects для багатьох груп (учень, предмет) одразу:
+    суми «попередніх» і «останніх» оцінок — різниці префіксних сум, тобто
+    один прохід по всіх рядках. Для цілих балів префіксні суми точні, тож
+    середні побітово ті самі, що й np.mean; групи з дробовими балами
+    рахуються матрицями однакової довжини (_worsening_flags_by_length).
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    ends = starts + sizes
+    tail = np.minimum(4, sizes // 2)
+
+    integral = scores_sorted == np.floor(scores_sorted)  # NaN теж не ціле
+    all_integral = bool(integral.all())
+    values = scores_sorted if all_integral else np.where(integral, scores_sorted, 0.0)
+
+    prefix = np.zeros(len(values) + 1)
+    np.cumsum(values, out=prefix[1:])
+    last_sum = prefix[ends] - prefix[ends - tail]
+    prev_sum = prefix[ends - tail] - prefix[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = (sizes >= 5) & (last_sum / tail <= prev_sum / (sizes - tail) - 0.5)
+
+    if not all_integral:
+        # Групи з NaN чи дробовими балами — як у повному перерахунку
+        # (np.mean з NaN дає NaN, і порівняння хибне)
+        non_integral = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(~integral, out=non_integral[1:])
+        irregular = np.flatnonzero((non_integral[ends] > non_integral[starts]) & (sizes >= 5))
+        out[irregular] = _worsening_flags_by_length(scores_sorted, starts[irregular], sizes[irregular])
+
+    return out
+
+
+def _worsening_flags_by_length(scores_sorted: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    out = np.zeros(len(sizes), dtype=bool)
+
+    for n in np.unique(sizes[sizes >= 5]):
+        n = int(n)
+        sel = np.flatnonzero(sizes == n)
+        m = scores_sorted[starts[sel, None] + np.arange(n)]
+
+        tail = min(4, n // 2)
+        prev_mean = m[:, :-tail].mean(axis=1)
+        last_mean = m[:, -tail:].mean(axis=1)
+        out[sel] = last_mean <= prev_mean - 0.5
+
+    return out
+
+
+@timed_stage("recommendations")
+def generate_recommendations_bulk(df_pred: pd.DataFrame) -> dict:
+    """
+    Те саме, що generate_direction_and_topic_recommendations, але для
+    багатьох учнів за один прохід: усі статистики рахуються групуванням
+    по student_id, без фільтрації DataFrame всередині циклів.
+    Повертає {student_id: (forecast_df, recommendations, weak_topics_struct)};
+    результат для кожного учня збігається з однострочною версією.
+    """
+    if df_pred.empty:
+        return {}
+
+    df = df_pred[[
+        "student_id", "subject_id", "subject_name", "topic",
+        "score", "predicted_level", "date_time_taken"
+    ]].copy()
+    df["direction"] = df["subject_id"].map(SUBJECT_DIRECTION_MAP).fillna("Інше")
+
+    # ============================================================
+    # 1. Статистика по темах
+    # ============================================================
+    topic_stats = (
+        df.groupby(["student_id", "direction", "subject_name", "topic"], observed=True)
+          .agg(avg_score=("score", "mean"), tests_count=("score", "count"))
+          .reset_index()
+    )
+    topic_stats["avg_score"] = topic_stats["avg_score"].round(2)
+
+    # ============================================================
+    # 2. Статистика по напрямках
+    # ============================================================
+    dir_stats = (
+        df.groupby(["student_id", "direction"])
+          .agg(
+              avg_score=("score", "mean"),
+              avg_level=("predicted_level", "mean"),
+              tests_count=("score", "count"),
+              rows=("score", "size"),
+          )
+          .reset_index()
+    )
+    dir_stats["avg_score"] = dir_stats["avg_score"].round(2)
+    dir_stats["avg_level"] = dir_stats["avg_level"].round(2)
+
+    # ============================================================
+    # 3. Прогноз для кожного (учень, напрямок)
+    # ============================================================
+    by_dir = df.sort_values(["student_id", "direction", "date_time_taken"], kind="stable")
+    starts, sizes = _group_bounds(dir_stats["rows"].to_numpy())
+    forecast = _forecast_scores_bulk(by_dir["score"].to_numpy(dtype=float), starts, sizes)
+
+    hist_level_num = np.rint(dir_stats["avg_level"].to_numpy()).astype(np.int64)
+    forecast_level_num = scores_to_levels(forecast).astype(np.int64)
+
+    forecast_all = pd.DataFrame({
+        "student_id": dir_stats["student_id"].to_numpy(),
+        "direction": dir_stats["direction"].to_numpy(),
+        "avg_score": dir_stats["avg_score"].to_numpy(dtype=float),
+        "hist_level": pd.Series(hist_level_num).map(level_to_name).to_numpy(),
+        "hist_level_num": hist_level_num,
+        "forecast_score": [round(x, 2) for x in forecast.tolist()],
+        "forecast_level": pd.Series(forecast_level_num).map(level_to_name).to_numpy(),
+        "forecast_level_num": forecast_level_num,
+        "forecast_level_display": np.where(
+            np.isnan(forecast),
+            "невідомий рівень",
+            pd.Series(forecast_level_num).map(LEVEL_SHORT_NAME)
+            + " (" + pd.Series(np.rint(np.nan_to_num(forecast)).astype(np.int64)).astype(str) + " балів)",
+        ).astype(object),
+        "tests_count": dir_stats["tests_count"].to_numpy(dtype=np.int64),
+    })
+
+    # ============================================================
+    # 4. Найсильніший напрямок
+    # ============================================================
+    primary = (
+        forecast_all.sort_values(
+            by=["student_id", "forecast_level_num", "forecast_score", "tests_count"],
+            ascending=[True, False, False, False],
+            kind="stable",
+        )
+        .drop_duplicates("student_id", keep="first")
+        .set_index("student_id")
+    )
+
+    # ============================================================
+    # 5. Слабкі напрямки (стара логіка)
+    # ============================================================
+    by_student = forecast_all.groupby("student_id")
+    n_dirs = by_student["direction"].transform("size")
+    min_level = by_student["forecast_level_num"].transform("min")
+    level_filtered = forecast_all[(n_dirs > 1) & (forecast_all["forecast_level_num"] == min_level)]
+    min_avg = level_filtered.groupby("student_id")["avg_score"].transform("min")
+    weak_dirs = level_filtered[level_filtered["avg_score"] <= min_avg + 0.5]
+
+    weak_dir_topics = topic_stats.merge(
+        weak_dirs[["student_id", "direction", "avg_score", "tests_count"]].rename(
+            columns={"avg_score": "dir_avg_score", "tests_count": "dir_tests_count"}
+        ),
+        on=["student_id", "direction"],
+        how="inner",
+    )
+    min_topic_avg = weak_dir_topics.groupby(["student_id", "direction"])["avg_score"].transform("min")
+    weak_dir_topics = weak_dir_topics[weak_dir_topics["avg_score"] <= min_topic_avg + 0.5]
+
+    weak_blocks: dict = {}
+    weak_topics_struct: dict = {}
+
+    weak_rows = zip(*(weak_dir_topics[c].tolist() for c in (
+        "student_id", "direction", "subject_name", "topic",
+        "avg_score", "dir_avg_score", "dir_tests_count"
+    )))
+
+    # Рядки вже впорядковані за (учень, напрямок, предмет, тема)
+    for (student_id, wd), part in groupby(weak_rows, key=lambda r: (r[0], r[1])):
+        part = list(part)
+        topic_descs = []
+        for _, _, subject, topic, t_avg, _, _ in part:
+            weak_topics_struct.setdefault(student_id, []).append({
+                "direction": wd,
                 "subject": subject,
-                "topic": trow["topic"],
-                "score": float(trow["score"]),
+                "topic": topic,
+                "score": float(t_avg),
             })
+            topic_descs.append(
+                f"{subject}, тема «{topic}» (середній бал {t_avg})"
+            )
 
-    weak_topics_struct.extend(weak_topics_all_subjects)
+        topics_str = "; ".join(topic_descs) if topic_descs else "—"
+        wd_avg_score, wd_tests = part[0][5], part[0][6]
+        weak_blocks.setdefault(student_id, []).append(
+            f"• напрямок «{wd}» (середній бал {wd_avg_score}, тестів {int(wd_tests)}); "
+            f"найбільше відстають: {topics_str}"
+        )
 
     # ============================================================
-    # 7. Погіршення у предметах (стара логіка)
+    # 6. Найслабші теми по ВСІХ ПРЕДМЕТАХ
     # ============================================================
-    worsening_subjects = find_worsening_subjects(df)
-    worsening_text = None
+    topic_means = (
+        df.groupby(["student_id", "subject_name", "topic"], observed=True)["score"]
+          .mean()
+          .reset_index()
+    )
+    topic_means["score"] = topic_means["score"].round(2)
 
-    if worsening_subjects:
-        subj_str = ", ".join(worsening_subjects)
-        worsening_text = (
-            f"Окремо слід звернути увагу на предмет(и): {subj_str}, "
-            f"де в динаміці результатів простежується зниження оцінок."
-        )
+    min_score = topic_means.groupby(["student_id", "subject_name"], observed=True)["score"].transform("min")
+    worst_topics = topic_means[
+        (topic_means["score"] == min_score) & (scores_to_levels(min_score) != 3)
+    ]
+
+    # Напрямок теми — за предметом першого запису учня з цією темою
+    first_subject = df.groupby(["student_id", "topic"], sort=False, observed=True)["subject_id"].first()
+    worst_directions = (
+        first_subject.reindex(pd.MultiIndex.from_frame(worst_topics[["student_id", "topic"]]))
+                     .map(detect_direction)
+                     .to_numpy()
+    )
+
+    weak_topics_all_subjects: dict = {}
+    for student_id, subject, topic, score, direction in zip(
+        worst_topics["student_id"].tolist(),
+        worst_topics["subject_name"].tolist(),
+        worst_topics["topic"].tolist(),
+        worst_topics["score"].tolist(),
+        worst_directions.tolist(),
+    ):
+        weak_topics_all_subjects.setdefault(student_id, []).append({
+            "direction": direction,
+            "subject": subject,
+            "topic": topic,
+            "score": float(score),
+        })
 
     # ============================================================
-    # 8. Формуємо текст рекомендацій
+    # 7. Погіршення у предметах
     # ============================================================
-    recommendations = []
+    by_subject = df.sort_values(["student_id", "subject_name", "date_time_taken"], kind="stable")
+    subject_sizes = df.groupby(["student_id", "subject_name"], observed=True).size()
+    s_starts, s_sizes = _group_bounds(subject_sizes.to_numpy())
+    flags = _worsening_flags_bulk(by_subject["score"].to_numpy(dtype=float), s_starts, s_sizes)
 
-    if primary_direction is not None:
-        recommendations.append(
+    worsening: dict = {}
+    for student_id, subject in subject_sizes.index[flags]:
+        worsening.setdefault(student_id, []).append(subject)
+
+    # ============================================================
+    # 8. Збираємо результат по кожному учню
+    # ============================================================
+    primary_info = dict(zip(
+        primary.index.tolist(),
+        zip(
+            primary["direction"].tolist(),
+            primary["avg_score"].tolist(),
+            primary["forecast_level_display"].tolist(),
+        ),
+    ))
+
+    forecast_body = forecast_all.drop(columns="student_id")
+    student_sizes = by_student.size()
+    f_starts, f_sizes = _group_bounds(student_sizes.to_numpy())
+
+    results = {}
+    for student_id, start, size in zip(student_sizes.index.tolist(), f_starts.tolist(), f_sizes.tolist()):
+        forecast_df = forecast_body.iloc[start:start + size].reset_index(drop=True)
+
+        primary_direction, primary_avg_score, primary_forecast_level_display = primary_info[student_id]
+
+        recommendations = [
             f"Основний освітній профіль: найсильніший напрямок — «{primary_direction}» "
-            f"(середній бал {primary_avg_score}, прогнозований рівень: {primary_forecast_level_display})."
-        )
-        recommendations.append(
-            f"Карʼєрні рекомендації: {CAREER_SUGGESTIONS.get(primary_direction)}."
-        )
+            f"(середній бал {primary_avg_score}, прогнозований рівень: {primary_forecast_level_display}).",
+            f"Карʼєрні рекомендації: {CAREER_SUGGESTIONS.get(primary_direction)}.",
+        ]
 
-    if weak_recommendation_text:
-        recommendations.append(weak_recommendation_text)
+        blocks = weak_blocks.get(student_id)
+        if blocks:
+            recommendations.append(
+                "Для збалансованого розвитку варто посилити підтримку "
+                "в таких напрямах та темах:\n" + "\n".join(blocks)
+            )
 
-    if worsening_text:
-        recommendations.append(worsening_text)
+        subjects = worsening.get(student_id)
+        if subjects:
+            subj_str = ", ".join(sorted(set(subjects)))
+            recommendations.append(
+                f"Окремо слід звернути увагу на предмет(и): {subj_str}, "
+                f"де в динаміці результатів простежується зниження оцінок."
+            )
 
-    return forecast_df, recommendations, weak_topics_struct
+        weak_topics = weak_topics_struct.get(student_id, []) + weak_topics_all_subjects.get(student_id, [])
+
+        results[int(student_id)] = (forecast_df, recommendations, weak_topics)
+
+    return results
 
 
 # ============================================================
 # 6. Збереження результатів аналізу в БД
 # ============================================================
 
-def upsert_student_analysis(student_id, scope, class_id,
-                            main_profile_text, career_text,
-                            weak_directions_text, worsening_subjects_text):
-    conn = pyodbc.connect(RAW_CONNECTION_STRING)
-    cursor = conn.cursor()
+def split_recommendation_texts(recs: list[str]):
+    """recommendations → (main_profile_text, career_text, weak_directions_text, worsening_subjects_text)."""
+    main_profile_text = recs[0] if len(recs) > 0 else None
+    career_text = recs[1] if len(recs) > 1 else None
 
-    if scope == "all":
-        cursor.execute("""
-            SELECT id FROM dbo.student_analysis
-            WHERE student_id = ? AND scope = N'all'
-        """, (student_id,))
-    else:
-        cursor.execute("""
-            SELECT id FROM dbo.student_analysis
-            WHERE student_id = ? AND scope = N'current_class' AND class_id = ?
-        """, (student_id, class_id))
-
-    row = cursor.fetchone()
-
-    if row:
-        analysis_id = row.id
-        cursor.execute("""
-            UPDATE dbo.student_analysis
-            SET 
-                class_id = ?, 
-                generated_at = SYSDATETIME(),
-                main_profile_text = ?,
-                career_text = ?,
-                weak_directions_text = ?,
-                worsening_subjects_text = ?
-            WHERE id = ?
-        """, (
-            class_id,
-            main_profile_text,
-            career_text,
-            weak_directions_text,
-            worsening_subjects_text,
-            analysis_id
-        ))
+    weak_directions_text = None
+    worsening_subjects_text = None
+
+    for r in recs[2:]:
+        if "напрямах та темах" in r:
+            weak_directions_text = r
+        elif "Окремо слід звернути увагу на предмет(и)" in r:
+            worsening_subjects_text = r
 
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return analysis_id
+    return main_profile_text, career_text, weak_directions_text, worsening_subjects_text
 
+
+INSERT_ANALYSIS_DIRECTION_SQL = """
+    INSERT INTO {schema}student_analysis_direction(
+        analysis_id, direction_name,
+        avg_score, hist_level,
+        forecast_score, forecast_level,
+        tests_count
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_ANALYSIS_WEAK_TOPIC_SQL = """
+    INSERT INTO {schema}student_analysis_weak_topics(
+        analysis_id,
+        direction_name,
+        subject_name,
+        topic_name,
+        topic_score
+    )
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+@timed_stage("persistence")
+def upsert_student_analyses(cursor, results: list[dict]) -> list[int]:
+    """
+    Вставляє або оновлює записи student_analysis для всіх results одним MERGE.
+    Ключ: (student_id, scope='all') або (student_id, scope='current_class', class_id).
+    Повертає analysis_id у порядку results.
+    """
     cursor.execute("""
-        INSERT INTO dbo.student_analysis(
-            student_id, scope, class_id,
+        CREATE TABLE #analysis_batch (
+            row_no INT NOT NULL PRIMARY KEY,
+            student_id INT NOT NULL,
+            scope NVARCHAR(20) NOT NULL,
+            class_id INT NULL,
+            main_profile_text NVARCHAR(MAX) NULL,
+            career_text NVARCHAR(MAX) NULL,
+            weak_directions_text NVARCHAR(MAX) NULL,
+            worsening_subjects_text NVARCHAR(MAX) NULL,
+            source_watermark NVARCHAR(200) NULL
+        );
+        CREATE TABLE #analysis_ids (
+            row_no INT NOT NULL PRIMARY KEY,
+            analysis_id INT NOT NULL
+        );
+    """)
+
+    rows = [
+        (
+            row_no,
+            int(r["student_id"]),
+            r["scope"],
+            None if r["class_id"] is None else int(r["class_id"]),
+            *split_recommendation_texts(r["recommendations"]),
+            r.get("source_watermark"),
+        )
+        for row_no, r in enumerate(results)
+    ]
+
+    import pyodbc
+
+    # NULL у першому рядку інакше ламає виведення типів у fast_executemany
+    cursor.setinputsizes([
+        (pyodbc.SQL_INTEGER, 0, 0),
+        (pyodbc.SQL_INTEGER, 0, 0),
+        (pyodbc.SQL_WVARCHAR, 20, 0),
+        (pyodbc.SQL_INTEGER, 0, 0),
+        (pyodbc.SQL_WLONGVARCHAR, 0, 0),
+        (pyodbc.SQL_WLONGVARCHAR, 0, 0),
+        (pyodbc.SQL_WLONGVARCHAR, 0, 0),
+        (pyodbc.SQL_WLONGVARCHAR, 0, 0),
+        (pyodbc.SQL_WVARCHAR, 200, 0),
+    ])
+    cursor.executemany("""
+        INSERT INTO #analysis_batch(
+            row_no, student_id, scope, class_id,
             main_profile_text, career_text,
-            weak_directions_text, worsening_subjects_text
-        ) OUTPUT INSERTED.id
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (
-        student_id, scope, class_id,
-        main_profile_text, career_text,
-        weak_directions_text, worsening_subjects_text
-    ))
+            weak_directions_text, worsening_subjects_text,
+            source_watermark
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    cursor.setinputsizes(None)
 
-    analysis_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return analysis_id
+    cursor.execute("""
+        MERGE dbo.student_analysis AS t
+        USING #analysis_batch AS s
+            ON t.student_id = s.student_id
+           AND t.scope = s.scope
+           AND (s.scope = N'all' OR t.class_id = s.class_id)
+        WHEN MATCHED THEN
+            UPDATE SET
+                class_id = s.class_id,
+                generated_at = SYSDATETIME(),
+                main_profile_text = s.main_profile_text,
+                career_text = s.career_text,
+                weak_directions_text = s.weak_directions_text,
+                worsening_subjects_text = s.worsening_subjects_text,
+                source_watermark = s.source_watermark
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (
+                student_id, scope, class_id,
+                main_profile_text, career_text,
+                weak_directions_text, worsening_subjects_text,
+                source_watermark
+            )
+            VALUES (
+                s.student_id, s.scope, s.class_id,
+                s.main_profile_text, s.career_text,
+                s.weak_directions_text, s.worsening_subjects_text,
+                s.source_watermark
+            )
+        OUTPUT s.row_no, inserted.id INTO #analysis_ids(row_no, analysis_id);
+    """)
+
+    cursor.execute("SELECT row_no, analysis_id FROM #analysis_ids ORDER BY row_no;")
+    ids = {row.row_no: row.analysis_id for row in cursor.fetchall()}
 
+    return [ids[row_no] for row_no in range(len(results))]
 
-def replace_analysis_directions(analysis_id, forecast_df: pd.DataFrame):
-    """Перезаписує статистику напрямків (direction rows)."""
-    conn = pyodbc.connect(RAW_CONNECTION_STRING)
-    cursor = conn.cursor()
 
-    # Видаляємо старі записи
+@timed_stage("persistence")
+def replace_analysis_details(cursor, analysis_ids: list[int], results: list[dict]):
+    """
+    Перезаписує статистику напрямків і слабкі теми для analysis_ids
+    (analysis_ids збігаються з #analysis_ids, створеною upsert_student_analyses).
+    """
+    # Видаляємо старі записи одним запитом на таблицю
     cursor.execute("""
-        DELETE FROM dbo.student_analysis_direction
-        WHERE analysis_id = ?
-    """, (analysis_id,))
-
-    # Додаємо нові
-    for _, row in forecast_df.iterrows():
-        cursor.execute("""
-            INSERT INTO dbo.student_analysis_direction(
-                analysis_id, direction_name,
-                avg_score, hist_level,
-                forecast_score, forecast_level,
-                tests_count
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            analysis_id,
-            row["direction"],
-            float(row["avg_score"]),
-            int(row["hist_level_num"]),
-            float(row["forecast_score"]),
-            int(row["forecast_level_num"]),
-            int(row["tests_count"])
+        DELETE d FROM dbo.student_analysis_direction AS d
+            INNER JOIN #analysis_ids AS a ON a.analysis_id = d.analysis_id;
+        DELETE w FROM dbo.student_analysis_weak_topics AS w
+            INNER JOIN #analysis_ids AS a ON a.analysis_id = w.analysis_id;
+    """)
+
+    direction_rows, weak_topic_rows = analysis_detail_rows(analysis_ids, results)
+
+    if direction_rows:
+        cursor.executemany(INSERT_ANALYSIS_DIRECTION_SQL.format(schema="dbo."), direction_rows)
+
+    if weak_topic_rows:
+        cursor.executemany(INSERT_ANALYSIS_WEAK_TOPIC_SQL.format(schema="dbo."), weak_topic_rows)
+
+
+# avg_score / forecast_score NaN (у напрямку лише NULL бали або один-два
+# рядки з NULL) у student_analysis_direction, де ці колонки NOT NULL;
+# справжні бали не бувають відʼємними
+MISSING_SCORE_SENTINEL = -1.0
+
+
+def analysis_detail_rows(analysis_ids: list[int], results: list[dict]):
+    """Рядки student_analysis_direction і student_analysis_weak_topics для results."""
+    direction_rows = []
+    weak_topic_rows = []
+
+    for analysis_id, r in zip(analysis_ids, results):
+        f = r["forecast_df"]
+        direction_rows.extend(zip(
+            [analysis_id] * len(f),
+            f["direction"].tolist(),
+            f["avg_score"].astype(float).fillna(MISSING_SCORE_SENTINEL).tolist(),
+            f["hist_level_num"].astype(int).tolist(),
+            f["forecast_score"].astype(float).fillna(MISSING_SCORE_SENTINEL).tolist(),
+            f["forecast_level_num"].astype(int).tolist(),
+            f["tests_count"].astype(int).tolist(),
         ))
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+        weak_topic_rows.extend(
+            (analysis_id, w["direction"], w["subject"], w["topic"], float(w["score"]))
+            for w in r["weak_topics"]
+        )
+
+    return direction_rows, weak_topic_rows
 
 
-def replace_analysis_weak_topics(analysis_id, weak_topics: list[dict]):
+@timed_stage("persistence")
+def save_analyses(results: list[dict]) -> list[int]:
     """
-    weak_topics — список dict:
-    [
-        {
-            "direction": "...",
-            "subject": "...",
-            "topic": "...",
-            "score": 6.0
-        },
-        ...
-    ]
+    Зберігає результати analyze_student()/analyze_students_bulk() однією
+    транзакцією (див. save_analyses у репозиторії джерела даних).
+    Повертає analysis_id у порядку results.
     """
-    conn = pyodbc.connect(RAW_CONNECTION_STRING)
-    cursor = conn.cursor()
+    if not results:
+        return []
+
+    return get_repository().save_analyses(results)
 
-    # видаляємо старі записи
-    cursor.execute("""
-        DELETE FROM dbo.student_analysis_weak_topics
-        WHERE analysis_id = ?
-    """, (analysis_id,))
-
-    # вставляємо нові
-    for w in weak_topics:
-        cursor.execute("""
-            INSERT INTO dbo.student_analysis_weak_topics(
-                analysis_id,
-                direction_name,
-                subject_name,
-                topic_name,
-                topic_score
-            )
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            analysis_id,
-            w["direction"],
-            w["subject"],
-            w["topic"],
-            float(w["score"])
-        ))
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+@timed_stage("persistence")
+def save_analysis(result: dict) -> int:
+    """Зберігає один результат analyze_student(); повертає analysis_id."""
+    return save_analyses([result])[0]
 
 
 # ============================================================
-# 7. Головна функція
+# 6.1. Актуальність збереженого аналізу
 # ============================================================
+#
+# Разом з аналізом зберігається source_watermark — кількість, остання дата
+# і сума балів проходжень, на яких він порахований, плюс відбиток моделі.
+# Якщо для учня ці значення не змінились, повторний аналіз дав би той самий
+# результат, тож його можна не рахувати й не перезаписувати.
+
+def model_digest(model, scaler) -> str:
+    h = hashlib.sha256()
+    for state in (model.to_state(), scaler.to_state()):
+        for key in sorted(state):
+            h.update(key.encode("utf-8"))
+            h.update(np.ascontiguousarray(state[key]).tobytes())
+    return h.hexdigest()[:16]
+
+
+def format_source_watermark(rows: int, max_taken, score_sum: float, digest: str) -> str:
+    # Дата з точністю до секунди: так її однаково повертають SQL Server і SQLite;
+    # якщо в усіх рядків date_time_taken NULL — порожнє поле
+    taken = "" if pd.isna(max_taken) else f"{pd.Timestamp(max_taken):%Y-%m-%d %H:%M:%S}"
+    return f"{int(rows)}|{taken}|{float(score_sum):.4f}|{digest}"
+
+
+def source_watermarks(df_scope: pd.DataFrame, digest: str) -> dict:
+    """{student_id: source_watermark} для вже відфільтрованих за scope рядків."""
+    summary = df_scope.assign(score=df_scope["score"].astype(np.float64)).groupby(
+        "student_id", sort=False, observed=True
+    ).agg(
+        rows=("score", "size"),
+        max_taken=("date_time_taken", "max"),
+        score_sum=("score", "sum"),
+    )
+    return {
+        int(student_id): format_source_watermark(rows, max_taken, score_sum, digest)
+        for student_id, rows, max_taken, score_sum in zip(
+            summary.index.tolist(),
+            summary["rows"].tolist(),
+            summary["max_taken"].tolist(),
+            summary["score_sum"].tolist(),
+        )
+    }
 
-def main():
-    df_all = load_all_scores()
 
-    df_student = df_all[df_all["student_id"] == TARGET_STUDENT_ID].copy()
-    print(f"DEBUG: student_id={TARGET_STUDENT_ID}, всього записів до фільтра: {len(df_student)}")
+def period_bounds(period) -> tuple:
+    """(date_from, date_to) періоду поточного класу для SQL або (None, None)."""
+    if period is not None and period[0] is not None and period[1] is not None:
+        return period[1], period[2]
+    return None, None
 
-    df_student = filter_student_scope(df_student)
-    print(f"DEBUG: після filter_student_scope, записів: {len(df_student)}")
 
-    if df_student.empty:
-        print("Після застосування фільтра періоду для цього студента не залишилось результатів.")
-        return
+@timed_stage("db")
+def unchanged_analysis_id(student_id: int, scope: str, period, model, scaler):
+    """
+    analysis_id збереженого аналізу, якщо з моменту його розрахунку не
+    змінились ні проходження учня в межах scope, ні модель; інакше None.
+    Актуальний аналіз позначається як перевірений (generated_at = зараз).
+    """
+    repo = get_repository()
+    class_id = period[0] if scope == "current_class" and period is not None else None
 
-    if df_all.empty:
-        print("У базі немає жодного завершеного тесту.")
-        return
+    date_from, date_to = period_bounds(period if scope == "current_class" else None)
 
-    # 1) Навчаємо глобальну модель на ВСІХ учнях
-    model, scaler = train_global_model(df_all)
+    stored, (rows, max_taken, score_sum) = fetch_concurrently(
+        lambda: repo.stored_analysis(student_id, scope, class_id),
+        lambda: repo.student_scores_summary(student_id, date_from, date_to),
+    )
+    if stored is None or stored[1] is None or rows == 0:
+        return None
+
+    analysis_id, stored_watermark = stored
+
+    if format_source_watermark(rows, max_taken, score_sum, model_digest(model, scaler)) != stored_watermark:
+        return None
+
+    repo.touch_analysis(analysis_id)
+    return analysis_id
+
+
+# ============================================================
+# 7. Аналіз одного студента
+# ============================================================
 
-    # 2) Беремо одного цільового учня
-    df_student = df_all[df_all["student_id"] == TARGET_STUDENT_ID].copy()
+@timed_stage("recommendations")
+def analyze_student(df_all: pd.DataFrame, model, scaler,
+                    student_id: int, scope: str, period=None):
+    """
+    Повний аналіз одного студента на вже завантажених даних
+    та вже навченій глобальній моделі (без запису в БД).
+    df_all — DataFrame або StudentIndex (тоді рядки учня — зріз без маски).
+    period — (class_id, date_from, date_to), якщо вже відомий.
+    Повертає dict з результатами або None, якщо аналізувати нічого.
+    """
+    df_student = student_rows(df_all, student_id)
 
     if df_student.empty:
-        print(f"Для студента ID={TARGET_STUDENT_ID} немає завершених тестів (state = 1).")
-        return
+        print(f"Для студента ID={student_id} немає завершених тестів (state = 1).")
+        return None
 
-    # 2.1) Фільтруємо за обраним періодом аналізу
-    df_student = filter_student_scope(df_student)
+    print(f"DEBUG: student_id={student_id}, всього записів до фільтра: {len(df_student)}")
+
+    # Період поточного класу визначаємо один раз
+    if scope == "current_class" and period is None:
+        period = get_current_class_period(student_id)
+
+    # Фільтруємо за обраним періодом аналізу
+    df_student = filter_student_scope(df_student, student_id, scope, period)
+    print(f"DEBUG: після filter_student_scope, записів: {len(df_student)}")
 
     if df_student.empty:
         print("Після застосування фільтра періоду для цього студента не залишилось результатів.")
-        return
+        return None
 
-    full_name = f"{df_student['last_name'].iloc[0]} " \
-                f"{df_student['first_name'].iloc[0]} " \
-                f"{df_student['patronymic_name'].iloc[0]}"
+    # class_id для scope='current_class'
+    class_id = period[0] if scope == "current_class" else None
 
-    print(f"\n=== ML-аналіз результатів студента: {full_name} (ID={TARGET_STUDENT_ID}) ===")
-    print(f"Режим аналізу: {ANALYSIS_SCOPE}\n")
+    remember_student_names(df_student)
+    full_name = student_full_names([student_id])[int(student_id)]
 
-    # 3) Застосовуємо модель до цього учня
+    # Застосовуємо модель до цього учня
     df_student_pred = apply_model_to_student(df_student, model, scaler)
 
-    # 4) Агрегація по напрямках + рекомендації + слабкі теми (структуровано)
+    # Агрегація по напрямках + рекомендації + слабкі теми (структуровано)
     forecast_df, recs, weak_topics_struct = generate_direction_and_topic_recommendations(df_student_pred)
 
+    return {
+        "student_id": student_id,
+        "scope": scope,
+        "class_id": class_id,
+        "full_name": full_name,
+        "forecast_df": forecast_df,
+        "recommendations": recs,
+        "weak_topics": weak_topics_struct,
+        "source_watermark": format_source_watermark(
+            len(df_student), df_student["date_time_taken"].max(),
+            df_student["score"].astype(np.float64).sum(), model_digest(model, scaler),
+        ),
+    }
+
+
+def print_analysis(result: dict):
+    print(f"\n=== ML-аналіз результатів студента: {result['full_name']} (ID={result['student_id']}) ===")
+    print(f"Режим аналізу: {result['scope']}\n")
+
     print(">>> Зведена статистика за напрямками (історія vs прогноз):")
-    for _, row in forecast_df.iterrows():
+    for _, row in result["forecast_df"].iterrows():
         print(
             f"- {row['direction']}: середній бал {row['avg_score']}, "
             f"тестів {int(row['tests_count'])}, "
@@ -807,69 +2907,755 @@ def main():
         )
 
     print("\n>>> Персоналізовані рекомендації за напрямками, темами та можливими кар'єрними траєкторіями:")
-    for r in recs:
+    for r in result["recommendations"]:
         print("-", r)
 
-    # ====================================================
-    # ЗБЕРЕЖЕННЯ АНАЛІЗУ В БД
-    # ====================================================
 
-    # 1) формуємо основні текстові блоки
-    main_profile_text = recs[0] if len(recs) > 0 else None
-    career_text = recs[1] if len(recs) > 1 else None
+def analysis_to_json(result: dict, analysis_id: int) -> dict:
+    """Результат аналізу у вигляді, придатному для json.dumps."""
+    return {
+        "analysis_id": int(analysis_id),
+        "student_id": int(result["student_id"]),
+        "scope": result["scope"],
+        "class_id": None if result["class_id"] is None else int(result["class_id"]),
+        "directions": result["forecast_df"].to_dict("records"),
+        "recommendations": result["recommendations"],
+        "weak_topics": result["weak_topics"],
+    }
 
-    weak_directions_text = None
-    worsening_subjects_text = None
 
-    for r in recs[2:]:
-        if "напрямах та темах" in r:
-            weak_directions_text = r
-        elif "Окремо слід звернути увагу на предмет(и)" in r:
-            worsening_subjects_text = r
+@timed_stage("db")
+def stored_analysis_to_json(analysis_id: int, student_id: int, scope: str, class_id) -> dict:
+    """
+    analysis_to_json для вже збереженого аналізу — з тих самих рядків, що
+    записав save_analyses. forecast_score у БД округлений до 2 знаків, тож
+    forecast_level_display рахується з нього; MISSING_SCORE_SENTINEL знову стає NaN.
+    """
+    texts, directions, weak_topics = get_repository().stored_analysis_details(analysis_id)
+
+    hist_level_num = directions["hist_level"].astype(int)
+    forecast_level_num = directions["forecast_level"].astype(int)
+    forecast_score = directions["forecast_score"].astype(float).replace(MISSING_SCORE_SENTINEL, np.nan)
+    forecast_df = pd.DataFrame({
+        "direction": directions["direction_name"],
+        "avg_score": directions["avg_score"].astype(float).replace(MISSING_SCORE_SENTINEL, np.nan),
+        "hist_level": hist_level_num.map(level_to_name),
+        "hist_level_num": hist_level_num,
+        "forecast_score": forecast_score,
+        "forecast_level": forecast_level_num.map(level_to_name),
+        "forecast_level_num": forecast_level_num,
+        "forecast_level_display": forecast_score.map(format_forecast_level),
+        "tests_count": directions["tests_count"].astype(int),
+    })
+
+    return analysis_to_json({
+        "student_id": student_id,
+        "scope": scope,
+        "class_id": class_id,
+        "forecast_df": forecast_df,
+        "recommendations": [t for t in texts if t is not None],
+        "weak_topics": [
+            {"direction": direction, "subject": subject, "topic": topic, "score": float(score)}
+            for direction, subject, topic, score in weak_topics.itertuples(index=False)
+        ],
+    }, analysis_id)
 
-    # 2) визначаємо class_id для scope='current_class'
-    class_id = None
-    if ANALYSIS_SCOPE == "current_class":
-        class_id, _, _ = get_current_class_period(TARGET_STUDENT_ID)
-
-    # 3) вставляємо або оновлюємо запис у student_analysis
-    analysis_id = upsert_student_analysis(
-        TARGET_STUDENT_ID,
-        ANALYSIS_SCOPE,
-        class_id,
-        main_profile_text,
-        career_text,
-        weak_directions_text,
-        worsening_subjects_text
-    )
 
-    # 4) вставляємо дані по напрямках
-    replace_analysis_directions(analysis_id, forecast_df)
+# ============================================================
+# 8. Головна функція
+# ============================================================
+
+@timed_stage("db")
+def load_student_scores(student_id: int, period=None) -> pd.DataFrame:
+    """
+    Проходження лише одного учня; якщо відомий період поточного класу,
+    межі дат теж застосовуються в SQL.
+    """
+    date_from, date_to = period_bounds(period)
+    return get_repository().read_scores(student_id=student_id, taken_from=date_from, taken_to=date_to)
+
+
+def stored_model_for(df: pd.DataFrame, stored=None):
+    """
+    (model, scaler) зі сховища, якщо модель бачила всі теми рядків df,
+    інакше None. topic_id стабільні (словник тем), тож достатньо перевірити,
+    що модель їх бачила.
+    """
+    if stored is None:
+        stored = _load_model_store()
+    compiled = _stored_model(stored)
+    if compiled is None or not isinstance(stored.get("topics"), dict):
+        return None
+    if not df["topic_id"].isin(list(stored["topics"].values())).all():
+        return None
+    return compiled
+
+
+def stored_model_is_current(stored, watermark=None) -> bool:
+    """
+    Чи навчена збережена модель на тих самих завершених тестах, що зараз
+    у БД: кількість рядків і сума балів її статистики (training_counts_state)
+    проти load_scores_watermark (watermark — уже прочитаний).
+    """
+    counts = None if stored is None else stored.get("counts")
+    if counts is None:
+        return False
+    rows, _, score_sum = load_scores_watermark() if watermark is None else watermark
+    return counts["rows"] == rows and math.isclose(counts["score_sum"], score_sum, rel_tol=1e-9, abs_tol=1e-4)
+
+
+def analyze_student_fast(student_id: int, scope: str, period=None, stored=None, watermark=None):
+    """
+    Аналіз одного учня без завантаження всієї таблиці: читаються лише його
+    рядки, а модель береться зі сховища (get_global_model; stored — уже
+    прочитане сховище, watermark — уже прочитаний load_scores_watermark).
+    Повертає (True, result) або (False, None), якщо швидкий шлях неможливий:
+    моделі ще немає, вона навчена на старіших даних або в учня є теми,
+    яких модель не бачила.
+    """
+    if stored is None:
+        stored = _load_model_store()
+    if _stored_model(stored) is None or not isinstance(stored.get("topics"), dict):
+        return False, None
+    if not stored_model_is_current(stored, watermark):
+        print("DEBUG: дані змінились після навчання збереженої моделі — потрібна модель, навчена на свіжих даних")
+        return False, None
+
+    df_student = analysis_frame(add_topics(load_student_scores(student_id, period)))
+
+    compiled = stored_model_for(df_student, stored)
+    if compiled is None:
+        print("DEBUG: у студента є нові теми — потрібна модель, навчена на свіжих даних")
+        return False, None
+
+    model, scaler = compiled
+    result = analyze_student(df_student, model, scaler, student_id, scope, period)
+    return True, result
+
+
+def main():
+    def load_period():
+        return get_current_class_period(TARGET_STUDENT_ID) if ANALYSIS_SCOPE == "current_class" else None
+
+    # 0) Період поточного класу — один раз на запуск, одночасно зі сховищем
+    #    моделі та watermark (а під --retrain — з усіма даними, які тоді потрібні напевно)
+    df_all = stored = watermark = None
+    if FORCE_RETRAIN:
+        period, df_all = fetch_concurrently(load_period, load_all_scores_cached)
+    else:
+        period, stored, watermark = fetch_concurrently(load_period, _load_model_store, load_scores_watermark)
+
+    # 1) Дані учня й модель не змінились — збережений аналіз актуальний
+    #    (лише якщо модель навчена на поточних даних, інакше її спершу оновлює get_global_model)
+    compiled = _stored_model(stored) if stored_model_is_current(stored, watermark) else None
+    if compiled is not None:
+        analysis_id = unchanged_analysis_id(TARGET_STUDENT_ID, ANALYSIS_SCOPE, period, *compiled)
+        if analysis_id is not None:
+            print(f"\n>>> Дані учня не змінились, збережений аналіз актуальний (analysis_id = {analysis_id})\n")
+            return
+
+    # 2) Швидкий шлях: лише рядки цього учня + збережена модель
+    handled, result = (False, None) if FORCE_RETRAIN else \
+        analyze_student_fast(TARGET_STUDENT_ID, ANALYSIS_SCOPE, period, stored, watermark)
+
+    if not handled:
+        if df_all is None:
+            df_all = load_all_scores_cached()
 
-    # 5) слабкі теми
-    replace_analysis_weak_topics(analysis_id, weak_topics_struct)
+        if df_all.empty:
+            print("У базі немає жодного завершеного тесту.")
+            return
+
+        # 2) Глобальна модель на ВСІХ учнях (збережена або навчена заново)
+        model, scaler = get_global_model(df_all, retrain=FORCE_RETRAIN)
+
+        # 3) Аналізуємо цільового учня
+        result = analyze_student(df_all, model, scaler, TARGET_STUDENT_ID, ANALYSIS_SCOPE, period)
+
+    if result is None:
+        return
+
+    print_analysis(result)
+
+    # 3) Зберігаємо аналіз у БД
+    analysis_id = save_analysis(result)
 
     print(f"\n>>> Результати збережено в БД (analysis_id = {analysis_id})\n")
 
-    df_student = df_all[df_all["student_id"] == TARGET_STUDENT_ID].copy()
-    print(f"DEBUG: student_id={TARGET_STUDENT_ID}, всього записів до фільтра: {len(df_student)}")
 
-    df_student = filter_student_scope(df_student)
-    print(f"DEBUG: після filter_student_scope, записів: {len(df_student)}")
+# ============================================================
+# 8.1. Пакетний режим: усі учні (або один клас) за один прохід
+# ============================================================
 
-    if df_student.empty:
-        print("Після застосування фільтра періоду для цього студента не залишилось результатів.")
+BATCH_CHUNK_STUDENTS = 500  # скільки учнів обробляє один процес за одне завдання
+
+_WORKER_MODEL = None
+_WORKER_SCALER = None
+
+
+@timed_stage("db")
+def load_class_student_ids(class_id: int) -> list[int]:
+    return get_repository().class_student_ids(class_id)
+
+
+def _init_batch_worker(model, scaler, repository):
+    """
+    Ініціалізатор процесу пулу: модель передається один раз на процес.
+    Джерело даних — нове (без успадкованих з батьківського процесу підключень).
+    """
+    global _WORKER_MODEL, _WORKER_SCALER, _REPOSITORY
+    _WORKER_MODEL = model
+    _WORKER_SCALER = scaler
+    _REPOSITORY = repository.for_worker()
+
+
+@timed_stage("recommendations")
+def analyze_students_bulk(df_students: pd.DataFrame, model, scaler, scope: str,
+                          periods: pd.DataFrame = None) -> list[dict]:
+    """
+    Аналіз багатьох учнів одразу (без запису в БД): модель застосовується
+    до всіх рядків за один виклик, а рекомендації рахує generate_recommendations_bulk.
+    periods — load_class_periods для цих учнів, якщо вже прочитані.
+    Повертає список результатів у форматі analyze_student.
+    """
+    class_ids = {}
+
+    if scope == "current_class":
+        if periods is None:
+            periods = load_class_periods(df_students["student_id"].unique())
+        class_ids = {int(k): int(v) for k, v in periods["class_id"].dropna().items()}
+        df_students = filter_current_class_bulk(df_students, periods)
+
+    if df_students.empty:
+        return []
+
+    df_pred = apply_model_to_student(df_students, model, scaler)
+    bulk = generate_recommendations_bulk(df_pred)
+    watermarks = source_watermarks(df_students, model_digest(model, scaler))
+
+    remember_student_names(df_students)
+    full_names = student_full_names(list(bulk))
+
+    results = []
+    for student_id, (forecast_df, recs, weak_topics_struct) in bulk.items():
+        results.append({
+            "student_id": student_id,
+            "scope": scope,
+            "class_id": class_ids.get(student_id),
+            "full_name": full_names[student_id],
+            "forecast_df": forecast_df,
+            "recommendations": recs,
+            "weak_topics": weak_topics_struct,
+            "source_watermark": watermarks[student_id],
+        })
+
+    return results
+
+
+def _analyze_students_worker(task):
+    df_chunk, names, periods, scope = task
+    _STUDENT_NAMES.update(names)
+    return analyze_students_bulk(df_chunk, _WORKER_MODEL, _WORKER_SCALER, scope, periods)
+
+
+def main_batch(scope: str, class_id=None, workers=None):
+    """
+    Аналіз усіх учнів (або лише учнів класу class_id):
+    дані завантажуються один раз, модель навчається один раз,
+    а учні діляться на порції, які обробляються пулом процесів.
+    """
+    # Учні класу й періоди поточного класу всіх учнів (один запит замість
+    # двох на кожного) читаються одночасно з усіма результатами
+    df_all, class_ids, periods = fetch_concurrently(
+        load_all_scores_cached,
+        lambda: None if class_id is None else load_class_student_ids(class_id),
+        lambda: load_class_periods() if scope == "current_class" else None,
+    )
+
+    if df_all.empty:
+        print("У базі немає жодного завершеного тесту.")
         return
 
+    # Модель — на ВСІХ учнях, навіть якщо аналізуємо один клас
+    model, scaler = get_global_model(df_all, retrain=FORCE_RETRAIN)
 
-if __name__ == "__main__":
-    if len(sys.argv) >= 2:
+    df_target = df_all
+    if class_ids is not None:
+        df_target = df_all[df_all["student_id"].isin(class_ids)]
+
+    # Кожна порція — рядки BATCH_CHUNK_STUDENTS учнів
+    student_ids = np.sort(df_target["student_id"].unique())
+    chunk_of = pd.Series(
+        np.arange(len(student_ids)) // BATCH_CHUNK_STUDENTS, index=student_ids
+    )
+    # ПІБ і періоди класу порції передаються разом з нею: у процесах пулу довідник порожній
+    def chunk_task(df_chunk):
+        chunk_ids = df_chunk["student_id"].unique()
+        chunk_periods = None if periods is None else periods[periods.index.isin(chunk_ids)]
+        return df_chunk, student_full_names(chunk_ids), chunk_periods, scope
+
+    tasks = [
+        chunk_task(df_chunk)
+        for _, df_chunk in df_target.groupby(df_target["student_id"].map(chunk_of), sort=True)
+    ]
+    print(f"DEBUG: пакетний аналіз {len(student_ids)} учнів у {len(tasks)} порціях (scope={scope})")
+
+    saved = 0
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_batch_worker,
+        initargs=(model, scaler, get_repository()),
+    ) as pool:
+        chunk_results = pool.map(_analyze_students_worker, tasks)
+        while True:
+            # Етапи всередині процесів-воркерів не видно, тож міряємо очікування порції
+            with stage("wait_batch_chunk", "recommendations"):
+                results = next(chunk_results, None)
+            if results is None:
+                break
+
+            # Одна транзакція на порцію учнів; якщо вона не вдалась — кожен учень
+            # порції окремо, щоб один збійний аналіз не зупиняв пакет
+            try:
+                analysis_ids = save_analyses(results)
+            except Exception as e:
+                print(f"УВАГА: не вдалося зберегти порцію з {len(results)} аналізів ({e}), зберігаємо поштучно")
+                analysis_ids = []
+                for result in results:
+                    try:
+                        analysis_ids += save_analyses([result])
+                    except Exception as e:
+                        failed.append(result["student_id"])
+                        print(f"УВАГА: student_id={result['student_id']}: аналіз не збережено: {e}")
+            saved += len(analysis_ids)
+            print(f"DEBUG: збережено порцію з {len(analysis_ids)} аналізів")
+
+    print(f"\n>>> Пакетний аналіз завершено: збережено {saved} з {len(student_ids)} аналізів\n")
+    if failed:
+        print(f">>> Не збережено аналізи {len(failed)} учнів: {', '.join(map(str, sorted(failed)))}\n")
+
+
+# ============================================================
+# 8.2. Режим спостереження: перерахунок після нових результатів
+# ============================================================
+#
+# Замість того щоб чекати, поки хтось відкриє сторінку й бекенд побачить
+# застарілий аналіз, процес періодично перевіряє load_scores_watermark і,
+# якщо він змінився, порівнює «підписи» учнів (student_score_signatures)
+# з попередніми та у фоні перераховує аналізи лише тих учнів, у яких щось
+# змінилось.
+
+WATCH_POLL_SECONDS = 10
+WATCH_BATCH_STUDENTS = 200  # учнів в одній мікропорції (і в одному IN (...))
+# Кожне стільки-те опитування підписи порівнюються навіть без зміни
+# watermark: переоцінка може не змінити ні кількість, ні суму балів
+WATCH_FULL_DIFF_EVERY = 30
+# Найбільша пауза (в опитуваннях) перед повтором для учня, чий аналіз не вдається
+WATCH_RETRY_MAX_POLLS = 64
+
+
+def score_signatures(df: pd.DataFrame) -> dict:
+    """{student_id: (cnt, max_taken, score_sum)} з результату student_score_signatures."""
+    return {
+        int(student_id): (cnt, max_taken, score_sum)
+        for student_id, cnt, max_taken, score_sum
+        in df[["student_id", "cnt", "max_taken", "score_sum"]].itertuples(index=False, name=None)
+    }
+
+
+def changed_student_ids(previous: dict, current: dict) -> list[int]:
+    """Учні, чий підпис зʼявився або змінився з попереднього опитування."""
+    return sorted(student_id for student_id, signature in current.items() if previous.get(student_id) != signature)
+
+
+@timed_stage("db")
+def load_students_scores(student_ids: list[int]) -> pd.DataFrame:
+    return analysis_frame(add_topics(get_repository().read_scores(student_ids=student_ids)))
+
+
+def refresh_students(student_ids: list[int], scopes) -> int:
+    """
+    Перераховує й зберігає аналізи учнів student_ids для кожного scope.
+    Читаються лише рядки цих учнів; модель — зі сховища, а якщо вона не
+    бачила якоїсь із їхніх тем, навчається заново на всіх даних.
+    Повертає кількість збережених аналізів.
+    """
+    df_students = load_students_scores(student_ids)
+    if df_students.empty:
+        return 0
+
+    compiled = None if FORCE_RETRAIN else stored_model_for(df_students)
+    if compiled is None:
+        compiled = get_global_model(load_all_scores_cached(), retrain=FORCE_RETRAIN)
+    model, scaler = compiled
+
+    saved = 0
+    for scope in scopes:
+        saved += len(save_analyses(analyze_students_bulk(df_students, model, scaler, scope)))
+    return saved
+
+
+def refresh_watched_students(student_ids: list[int], scopes) -> tuple:
+    """
+    refresh_students для мікропорції; якщо вона не вдалась, учні
+    перераховуються поштучно. Повертає (кількість збережених аналізів,
+    учні, чий перерахунок не вдався).
+    """
+    try:
+        return refresh_students(student_ids, scopes), []
+    except Exception as e:
+        if len(student_ids) == 1:
+            print(f"УВАГА: student_id={student_ids[0]}: перерахунок не вдався: {e}")
+            return 0, list(student_ids)
+        print(f"УВАГА: мікропорція з {len(student_ids)} учнів не вдалась ({e}), перераховуємо поштучно")
+
+    saved, failed = 0, []
+    for student_id in student_ids:
         try:
-            TARGET_STUDENT_ID = int(sys.argv[1])
-        except ValueError:
-            print(f"Некоректний student_id: {sys.argv[1]}")
+            saved += refresh_students([student_id], scopes)
+        except Exception as e:
+            failed.append(student_id)
+            print(f"УВАГА: student_id={student_id}: перерахунок не вдався: {e}")
+    return saved, failed
+
+
+def main_watch(scopes, poll_seconds: float = WATCH_POLL_SECONDS, batch_students: int = WATCH_BATCH_STUDENTS):
+    """
+    Нескінченний цикл опитування student_test. Перше опитування лише
+    запамʼятовує стан (повний перерахунок — це пакетний режим). Підписи
+    читаються лише при зміні watermark (і кожне WATCH_FULL_DIFF_EVERY
+    опитування). Підпис учня оновлюється після успішного перерахунку;
+    учні, чий перерахунок не вдався, повторюються зі зростаючою паузою
+    і не затримують решту.
+    """
+    repo = get_repository()
+    watermark = load_scores_watermark()
+    signatures = score_signatures(repo.student_score_signatures())
+    retry_at = {}  # student_id -> (опитування, з якого повторювати, поточна пауза)
+    print(f"Спостереження за student_test: {len(signatures)} учнів, опитування кожні {poll_seconds} с "
+          f"(scope: {', '.join(scopes)})")
+
+    poll = 0
+    try:
+        while True:
+            time.sleep(poll_seconds)
+            poll += 1
+
+            # Без stage(): записи метрик зберігаються до flush_metrics, а порожні
+            # опитування нічого не скидають
+            current_watermark = load_scores_watermark()
+            retry_due = any(at <= poll for at, _ in retry_at.values())
+            if current_watermark == watermark and poll % WATCH_FULL_DIFF_EVERY and not retry_due:
+                continue
+
+            # watermark — до підписів: зміна між двома запитами лише дасть ще одне порівняння
+            watermark = current_watermark
+            current = score_signatures(repo.student_score_signatures())
+            student_ids = [
+                student_id for student_id in changed_student_ids(signatures, current)
+                if student_id not in retry_at or retry_at[student_id][0] <= poll
+            ]
+            if not student_ids:
+                continue
+
+            started = time.perf_counter()
+            saved, failed = 0, []
+            try:
+                for start in range(0, len(student_ids), batch_students):
+                    batch = student_ids[start:start + batch_students]
+                    batch_saved, batch_failed = refresh_watched_students(batch, scopes)
+                    saved += batch_saved
+                    failed += batch_failed
+
+                    for student_id in set(batch) - set(batch_failed):
+                        signatures[student_id] = current[student_id]
+                        retry_at.pop(student_id, None)
+                    for student_id in batch_failed:
+                        delay = min(2 * retry_at.get(student_id, (0, 0))[1] or 1, WATCH_RETRY_MAX_POLLS)
+                        retry_at[student_id] = (poll + delay, delay)
+            finally:
+                flush_metrics("watch", students=len(student_ids), failed=len(failed), scopes=list(scopes))
+
+            print(f">>> Перераховано {saved} аналізів для {len(student_ids) - len(failed)} учнів "
+                  f"за {time.perf_counter() - started:.2f} с")
+            if failed:
+                print(f">>> Не вдалося перерахувати {len(failed)} учнів: {', '.join(map(str, failed))}; "
+                      f"повтор пізніше")
+    except KeyboardInterrupt:
+        pass
+
+
+# ============================================================
+# 9. Режим сервера аналізу (резидентний процес)
+# ============================================================
+
+ANALYSIS_SERVER_HOST = "127.0.0.1"
+ANALYSIS_SERVER_PORT = 8765
+ANALYSIS_SERVER_WORKERS = 4  # скільки різних учнів аналізується одночасно
+
+
+class AnalysisService:
+    """
+    Тримає в памʼяті дані всіх учнів та навчену глобальну модель між запитами.
+    Дані й модель перезавантажуються лише тоді, коли змінився
+    load_scores_watermark: зʼявились нові завершені тести або змінився
+    бал уже завершеного (дооцінене відкрите питання).
+
+    Аналізи виконуються пулом з workers потоків. Одночасні запити для того
+    самого (student_id, scope) чекають на один розрахунок, а не запускають
+    кожен свій і не змагаються за той самий рядок student_analysis.
+    """
+
+    def __init__(self, workers: int = None):
+        self._lock = threading.Lock()
+        self._loaded = (None, None)  # (watermark, (StudentIndex, model, scaler)) — заміна одним присвоєнням
+
+        self._pool = ThreadPoolExecutor(max_workers=workers or ANALYSIS_SERVER_WORKERS,
+                                        thread_name_prefix="analysis")
+        self._in_flight_lock = threading.Lock()
+        self._in_flight = {}  # (student_id, scope) -> Future
+
+    def _ensure_fresh(self):
+        # Запит watermark — без блокування: запити різних учнів не чекають один на одного.
+        # Блокування потрібне лише для перезавантаження
+        watermark = load_scores_watermark()
+        loaded_watermark, state = self._loaded
+        if state is not None and watermark == loaded_watermark:
+            return state
+
+        with self._lock:
+            # Поки чекали, дані могли вже перезавантажити
+            loaded_watermark, state = self._loaded
+            if state is not None and watermark == loaded_watermark:
+                return state
+
+            print(f"DEBUG: перезавантаження даних та моделі (watermark={watermark})")
+            df_all = load_all_scores_cached()
+            if df_all.empty:
+                new_state = (StudentIndex(df_all), None, None)
+            else:
+                model, scaler = get_global_model(df_all, retrain=FORCE_RETRAIN and state is None)
+                new_state = (StudentIndex(df_all), model, scaler)
+            self._loaded = (watermark, new_state)
+            return new_state
+
+    def analyze(self, student_id: int, scope: str):
+        key = (student_id, scope)
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            started = future is None
+            if started:
+                future = self._pool.submit(self._analyze, student_id, scope)
+                self._in_flight[key] = future
+
+        if started:
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            print(f"DEBUG: student_id={student_id}, scope={scope}: чекаємо на вже запущений аналіз")
+
+        return future.result()
+
+    def _forget(self, key, future):
+        with self._in_flight_lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+    def _analyze(self, student_id: int, scope: str):
+        # Перевірка свіжості даних і період класу — незалежні запити
+        (scores, model, scaler), period = fetch_concurrently(
+            self._ensure_fresh,
+            lambda: get_current_class_period(student_id) if scope == "current_class" else None,
+        )
+        if scores.empty:
+            return None
 
-    if len(sys.argv) >= 3:
-        ANALYSIS_SCOPE = sys.argv[2]
+        analysis_id = unchanged_analysis_id(student_id, scope, period, model, scaler)
+        if analysis_id is not None:
+            # Та сама відповідь, що й після розрахунку, але зі збереженого аналізу
+            class_id = period[0] if scope == "current_class" and period is not None else None
+            payload = stored_analysis_to_json(analysis_id, student_id, scope, class_id)
+            flush_metrics("serve", student_id=student_id, scope=scope, unchanged=True)
+            return payload
 
-    main()
+        result = analyze_student(scores, model, scaler, student_id, scope, period)
+        if result is None:
+            return None
+
+        analysis_id = save_analysis(result)
+        flush_metrics("serve", student_id=student_id, scope=scope)
+        return analysis_to_json(result, analysis_id)
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /analyze  {"student_id": 1, "scope": "all"}  → JSON з результатами
+    GET  /health                                       → {"status": "ok"}
+    """
+    service: AnalysisService = None
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/analyze":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            student_id = int(request["student_id"])
+            scope = request.get("scope") or "all"
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": "очікується JSON {\"student_id\": int, \"scope\": str}"})
+            return
+
+        if scope not in ANALYSIS_SCOPES:
+            self._send_json(400, {"error": "scope має бути 'all' або 'current_class'"})
+            return
+
+        try:
+            payload = self.service.analyze(student_id, scope)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+
+        if payload is None:
+            self._send_json(404, {"error": "немає результатів для аналізу"})
+            return
+
+        self._send_json(200, payload)
+
+
+def serve(host: str = ANALYSIS_SERVER_HOST, port: int = ANALYSIS_SERVER_PORT, workers: int = None):
+    service = AnalysisRequestHandler.service = AnalysisService(workers)
+    server = ThreadingHTTPServer((host, port), AnalysisRequestHandler)
+    print(f"Сервер аналізу слухає http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="ML-аналіз результатів студентів")
+    parser.add_argument("student_id", nargs="?", help="ID студента, якого аналізуємо")
+    parser.add_argument("scope", nargs="?", choices=ANALYSIS_SCOPES,
+                        help="'all' або 'current_class' (те саме, що --scope)")
+    parser.add_argument("--scope", dest="scope_option", choices=ANALYSIS_SCOPES + ("both",),
+                        help="обсяг аналізу для одного учня, --all-students, --class-id і --watch; "
+                             "'both' — лише для --watch (за замовчуванням для нього)")
+    parser.add_argument("--serve", action="store_true",
+                        help="запустити резидентний HTTP-сервер аналізу")
+    parser.add_argument("--watch", action="store_true",
+                        help="стежити за новими результатами в student_test і перераховувати аналізи змінених учнів")
+    parser.add_argument("--poll-seconds", type=float, default=WATCH_POLL_SECONDS,
+                        help="інтервал опитування student_test для --watch")
+    parser.add_argument("--all-students", action="store_true",
+                        help="пакетний аналіз усіх учнів")
+    parser.add_argument("--class-id", type=int,
+                        help="пакетний аналіз учнів одного класу")
+    parser.add_argument("--source", default=DATA_SOURCE,
+                        help="джерело даних: 'mssql' (за замовчуванням) або 'sqlite:<шлях до файлу>'")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help="тека для знімка student_test, моделі та словника тем")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="не використовувати локальний знімок student_test (завжди повне читання з БД)")
+    parser.add_argument("--retrain", action="store_true",
+                        help="перенавчити глобальну модель, навіть якщо дані не змінились")
+    parser.add_argument("--workers", type=int,
+                        help="кількість процесів для пакетного режиму (за замовчуванням — кількість ядер) "
+                             f"або потоків аналізу для --serve (за замовчуванням {ANALYSIS_SERVER_WORKERS})")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="дописувати час, кількість рядків і пікову памʼять кожного етапу в JSON Lines файл")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="зберегти статистику cProfile (для pstats / snakeviz)")
+    parser.add_argument("--host", default=ANALYSIS_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=ANALYSIS_SERVER_PORT)
+    args = parser.parse_args(argv)
+
+    # Пакетні режими не мають student_id, тож єдиний позиційний аргумент
+    # (`--class-id 5 current_class`) — це обсяг аналізу.
+    if args.student_id in ANALYSIS_SCOPES and args.scope is None:
+        args.student_id, args.scope = None, args.student_id
+    if args.scope is not None and args.scope_option is not None and args.scope != args.scope_option:
+        parser.error(f"обсяг задано двічі: {args.scope} і --scope {args.scope_option}")
+    args.scope = args.scope_option or args.scope
+    if args.scope == "both" and not args.watch:
+        parser.error("--scope both підтримується лише з --watch")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+
+    if args.student_id is not None:
+        try:
+            TARGET_STUDENT_ID = int(args.student_id)
+        except ValueError:
+            print(f"Некоректний student_id: {args.student_id}")
+
+    if args.scope in ANALYSIS_SCOPES:
+        ANALYSIS_SCOPE = args.scope
+
+    if args.no_snapshot:
+        USE_SCORES_SNAPSHOT = False
+
+    CACHE_DIR = os.path.abspath(args.cache_dir)
+    use_repository(make_repository(args.source))
+
+    if args.retrain:
+        FORCE_RETRAIN = True
+
+    if args.metrics:
+        enable_metrics(args.metrics)
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    started = time.perf_counter()
+    try:
+        if args.serve:
+            mode = "serve"
+            serve(args.host, args.port, workers=args.workers)
+        elif args.watch:
+            mode = "watch"
+            watch_scopes = (args.scope,) if args.scope in ANALYSIS_SCOPES else ANALYSIS_SCOPES
+            main_watch(watch_scopes, args.poll_seconds)
+        elif args.all_students or args.class_id is not None:
+            mode = "batch"
+            main_batch(ANALYSIS_SCOPE, class_id=args.class_id, workers=args.workers)
+        else:
+            mode = "single"
+            main()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        flush_metrics(
+            mode,
+            student_id=TARGET_STUDENT_ID if mode == "single" else None,
+            scope=",".join(watch_scopes) if mode == "watch" else ANALYSIS_SCOPE,
+            class_id=args.class_id,
+            total_wall_s=round(time.perf_counter() - started, 6),
+        )
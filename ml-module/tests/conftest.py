@@ -0,0 +1,26 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def generated_db(tmp_path_factory):
+    """Невелика синтетична EduTestDB (генератор бенчмарку), спільна для всіх тестів."""
+    path = str(tmp_path_factory.mktemp("db") / "edutest.sqlite")
+    benchmark.generate_database(path, attempts=20_000, students=120, tests=60, seed=7)
+    return path
+
+
+@pytest.fixture
+def db_path(generated_db, tmp_path):
+    """Копія бази для одного тесту (тести змінюють student_test) з main.py, привʼязаним до неї."""
+    path = str(tmp_path / "edutest.sqlite")
+    shutil.copy(generated_db, path)
+    benchmark.bind_main_to_sqlite(path, str(tmp_path))
+    return path
@@ -0,0 +1,69 @@
+import sqlite3
+
+import pytest
+from pandas.testing import assert_frame_equal
+
+import main
+
+
+@pytest.fixture
+def scores(db_path):
+    """
+    Проходження з однаковими date_time_taken (на початку й наприкінці історії,
+    де вага прогнозу найбільша), NULL балами і NULL датами, у перемішаному порядку.
+    """
+    with sqlite3.connect(db_path) as conn:
+        for agg, step in (("MIN", 7), ("MAX", 3)):
+            conn.execute(f"""
+                UPDATE student_test
+                SET date_time_taken = (SELECT {agg}(t.date_time_taken) FROM student_test AS t
+                                       WHERE t.student_id = student_test.student_id)
+                WHERE id % {step} = 0
+            """)
+        conn.execute("UPDATE student_test SET score = NULL WHERE state = 1 AND id % 53 = 0")
+        conn.execute("UPDATE student_test SET date_time_taken = NULL WHERE id % 61 = 0")
+
+    df = main.load_all_scores().sample(frac=1, random_state=11).reset_index(drop=True)
+    assert df["score"].isna().any() and df["date_time_taken"].isna().any()
+    assert df.duplicated(["student_id", "date_time_taken"]).any()
+    return df
+
+
+def _assert_same_analysis(actual: dict, expected: dict):
+    for key in ("student_id", "scope", "class_id", "full_name", "recommendations", "weak_topics", "source_watermark"):
+        assert actual[key] == expected[key], key
+    assert_frame_equal(actual["forecast_df"].reset_index(drop=True), expected["forecast_df"].reset_index(drop=True))
+
+
+@pytest.mark.parametrize("scope", main.ANALYSIS_SCOPES)
+def test_bulk_engine_matches_single_student(scores, scope):
+    model, scaler = main.get_global_model(scores)
+    bulk = main.analyze_students_bulk(scores, model, scaler, scope)
+    assert bulk
+
+    index = main.StudentIndex(scores)
+    for result in bulk[:40]:
+        student_id = result["student_id"]
+        _assert_same_analysis(result, main.analyze_student(scores, model, scaler, student_id, scope))
+        _assert_same_analysis(result, main.analyze_student(index, model, scaler, student_id, scope))
+
+
+def test_bulk_engine_matches_baseline_routines(scores):
+    """Прогноз і погіршення предметів — як у початкових функціях на зрізі одного учня."""
+    model, scaler = main.get_global_model(scores)
+
+    for result in main.analyze_students_bulk(scores, model, scaler, "all"):
+        df_student = scores[scores["student_id"] == result["student_id"]]
+        directions = df_student["subject_id"].apply(main.detect_direction)
+
+        for row in result["forecast_df"].itertuples():
+            expected = main.forecast_direction_score(df_student[directions == row.direction])
+            assert row.forecast_score == round(expected, 2)
+            assert row.tests_count == df_student["score"][directions == row.direction].notna().sum()
+
+        worsening = main.find_worsening_subjects(df_student)
+        worsening_texts = [r for r in result["recommendations"] if "Окремо слід звернути увагу" in r]
+        if worsening:
+            assert worsening_texts and all(subject in worsening_texts[0] for subject in worsening)
+        else:
+            assert not worsening_texts
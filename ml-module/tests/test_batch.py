@@ -0,0 +1,43 @@
+import math
+import sqlite3
+
+import numpy as np
+
+import main
+
+
+def test_batch_continues_after_a_failing_student(db_path, monkeypatch, capsys):
+    monkeypatch.setattr(main, "BATCH_CHUNK_STUDENTS", 25)
+    failing_student = 7
+    save_analyses = main.save_analyses
+
+    def flaky_save(results):
+        if any(r["student_id"] == failing_student for r in results):
+            raise sqlite3.IntegrityError("NOT NULL constraint failed")
+        return save_analyses(results)
+
+    monkeypatch.setattr(main, "save_analyses", flaky_save)
+    main.main_batch("all", workers=1)
+
+    students = main.load_all_scores()["student_id"].nunique()
+    out = capsys.readouterr().out
+    assert f"збережено {students - 1} з {students} аналізів" in out
+    assert f"Не збережено аналізи 1 учнів: {failing_student}" in out
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM student_analysis").fetchone()[0] == students - 1
+
+
+def test_nan_scores_are_saved_and_restored(db_path):
+    df = main.load_all_scores()
+    model, scaler = main.get_global_model(df)
+    result = main.analyze_student(df, model, scaler, int(df["student_id"].iloc[0]), "all")
+    result["forecast_df"].loc[0, ["avg_score", "forecast_score"]] = np.nan
+    result["forecast_df"].loc[0, "forecast_level_display"] = main.format_forecast_level(np.nan)
+
+    [analysis_id] = main.save_analyses([result])
+
+    restored = main.stored_analysis_to_json(analysis_id, result["student_id"], "all", None)
+    direction = restored["directions"][0]
+    assert math.isnan(direction["avg_score"]) and math.isnan(direction["forecast_score"])
+    assert direction["forecast_level_display"] == "невідомий рівень"
+    assert restored["directions"][1:] == main.analysis_to_json(result, analysis_id)["directions"][1:]
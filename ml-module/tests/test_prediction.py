@@ -0,0 +1,43 @@
+import sqlite3
+import warnings
+
+import numpy as np
+
+import main
+
+
+def _scores_with_nulls(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE student_test SET score = NULL WHERE state = 1 AND id % 50 = 0")
+    df = main.load_all_scores()
+    assert df["score"].isna().any()
+    return df
+
+
+def test_compiled_tree_matches_sklearn_with_null_scores(db_path):
+    df = _scores_with_nulls(db_path)
+    model, scaler = main.train_global_model(df)
+    model_c, scaler_c = main.compile_model(model, scaler)
+
+    X = df[main.MODEL_FEATURES]
+    expected = model.predict(scaler.transform(X))
+
+    assert np.array_equal(model_c.predict(scaler_c.transform(X.to_numpy())), expected)
+    restored = main.CompiledTree.from_state(model_c.to_state())
+    assert np.array_equal(restored.predict(scaler_c.transform(X.to_numpy())), expected)
+
+
+def test_prediction_table_sends_null_scores_to_tree(db_path):
+    df = _scores_with_nulls(db_path)
+    model, scaler = main.train_global_model(df)
+    model_c, scaler_c = main.compile_model(model, scaler)
+    main.compile_prediction_table(model_c, scaler_c, df)
+    assert model_c.table is not None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        _, hit = model_c.table.lookup(*(df[col].to_numpy() for col in main.MODEL_FEATURES))
+        predicted = main.apply_model_to_student(df, model_c, scaler_c)["predicted_level"]
+
+    assert not hit[df["score"].isna().to_numpy()].any()
+    assert np.array_equal(predicted.to_numpy(), model.predict(scaler.transform(df[main.MODEL_FEATURES])))
@@ -0,0 +1,15 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("cls", [main.EduTestRepository, main.SqlEduTestRepository])
+def test_abstract_repositories_cannot_be_created(cls):
+    with pytest.raises(TypeError):
+        cls()
+
+
+def test_repositories_implement_the_interface(db_path):
+    assert not main.MssqlRepository.__abstractmethods__
+    repo = main.SqliteRepository(db_path)
+    assert repo.scores_watermark()[0] > 0
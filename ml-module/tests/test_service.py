@@ -0,0 +1,60 @@
+import json
+import threading
+
+import pandas as pd
+
+import main
+
+
+def _json(payload):
+    return json.loads(json.dumps(payload, ensure_ascii=False, default=str))
+
+
+def test_unchanged_response_matches_computed_response(db_path, monkeypatch):
+    student_ids = main.load_all_scores()["student_id"].drop_duplicates().head(10).astype(int).tolist()
+    service = main.AnalysisService(workers=1)
+    try:
+        computed = {(s, scope): service.analyze(s, scope) for scope in main.ANALYSIS_SCOPES for s in student_ids}
+
+        def not_expected(*args, **kwargs):
+            raise AssertionError("аналіз не змінився, перерахунок не потрібен")
+
+        monkeypatch.setattr(main, "analyze_student", not_expected)
+        for (student_id, scope), payload in computed.items():
+            if payload is not None:
+                assert _json(service.analyze(student_id, scope)) == _json(payload)
+    finally:
+        service.shutdown()
+
+
+def test_source_watermark_without_dates():
+    assert main.format_source_watermark(3, pd.NaT, 21.5, "abc") == "3||21.5000|abc"
+    assert main.format_source_watermark(3, None, 21.5, "abc") == "3||21.5000|abc"
+
+
+def test_watermark_query_does_not_block_other_requests(db_path, monkeypatch):
+    service = main.AnalysisService(workers=2)
+    try:
+        state = service._ensure_fresh()
+
+        read_watermark = main.load_scores_watermark
+        entered, release = threading.Event(), threading.Event()
+
+        def slow_watermark():
+            if not entered.is_set():
+                entered.set()
+                release.wait(10)
+            return read_watermark()
+
+        monkeypatch.setattr(main, "load_scores_watermark", slow_watermark)
+        slow = threading.Thread(target=service._ensure_fresh)
+        slow.start()
+        assert entered.wait(10)
+
+        # Повільний запит watermark не тримає блокування сервісу
+        assert service._ensure_fresh() is state
+        release.set()
+        slow.join(10)
+    finally:
+        release.set()
+        service.shutdown()
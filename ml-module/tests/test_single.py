@@ -0,0 +1,25 @@
+import sqlite3
+
+import main
+
+
+def test_single_analysis_refreshes_a_stale_model(db_path, monkeypatch, capsys):
+    monkeypatch.setattr(main, "TARGET_STUDENT_ID", 1)
+    monkeypatch.setattr(main, "ANALYSIS_SCOPE", "all")
+
+    main.main()
+    main.main()
+    assert "збережений аналіз актуальний" in capsys.readouterr().out
+
+    # Новий результат іншого учня: аналіз учня 1 той самий, але модель застаріла
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("""
+            INSERT INTO student_test(student_id, test_id, score, date_time_taken, state)
+            SELECT 2, test_id, 4, '2030-01-01 10:00:00', 1 FROM student_test WHERE student_id = 2 LIMIT 1
+        """)
+
+    main.main()
+    out = capsys.readouterr().out
+    assert "дані змінились після навчання збереженої моделі" in out
+    assert "збережений аналіз актуальний" not in out
+    assert main.stored_model_is_current(main._load_model_store())
@@ -0,0 +1,59 @@
+import sqlite3
+
+import main
+
+
+def _digest(compiled):
+    return main.model_digest(*compiled)
+
+
+def _full_fit(df):
+    return main.compile_model(*main.train_global_model(df))
+
+
+def test_counts_fit_matches_full_fit_with_null_scores(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE student_test SET score = NULL WHERE state = 1 AND id % 50 = 0")
+
+    df = main.load_all_scores()
+    assert df["score"].isna().any()
+
+    counts = main.training_counts(df)
+    assert counts["count"].sum() == len(df)
+    assert _digest(main.compile_model(*main.train_global_model_from_counts(counts))) == _digest(_full_fit(df))
+
+
+def test_incremental_update_with_null_scores(db_path, capsys):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE student_test SET score = NULL WHERE state = 1 AND id % 50 = 0")
+
+    df = main.load_all_scores()
+    cut = df["date_time_taken"].quantile(0.8)
+    main.get_global_model(df[df["date_time_taken"] <= cut])
+    capsys.readouterr()
+
+    model, scaler = main.get_global_model(df)
+
+    assert "інкрементальне оновлення статистики" in capsys.readouterr().out
+    assert main.model_digest(model, scaler) == _digest(_full_fit(df))
+
+
+def test_changed_old_rows_force_full_recount(db_path, capsys):
+    df = main.load_all_scores()
+    main.get_global_model(df.iloc[1:])
+    capsys.readouterr()
+
+    model, scaler = main.get_global_model(df)
+
+    assert "інкрементальне оновлення статистики" not in capsys.readouterr().out
+    assert main.model_digest(model, scaler) == _digest(_full_fit(df))
+
+
+def test_refit_over_budget_uses_counts_only(db_path, capsys, monkeypatch):
+    monkeypatch.setattr(main, "MODEL_TRAIN_BUDGET_ROWS", 1000)
+    df = main.load_all_scores()
+
+    model, scaler = main.get_global_model(df, retrain=True)
+
+    assert "навчання лише зі статистики" in capsys.readouterr().out
+    assert main.model_digest(model, scaler) == _digest(_full_fit(df))
@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+import main
+
+
+def _add_result(db_path, student_id):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("""
+            INSERT INTO student_test(student_id, test_id, score, date_time_taken, state)
+            SELECT student_id, test_id, 9, '2030-01-01 10:00:00', 1
+            FROM student_test WHERE student_id = ? AND state = 1 LIMIT 1
+        """, (student_id,))
+
+
+def test_watch_isolates_failing_students(db_path, monkeypatch):
+    failing, healthy = 3, 5
+    polls = {
+        2: lambda: (_add_result(db_path, failing), _add_result(db_path, healthy)),
+        4: lambda: _add_result(db_path, healthy),
+    }
+    poll = 0
+
+    def fake_sleep(seconds):
+        nonlocal poll
+        poll += 1
+        if poll > 6:
+            raise KeyboardInterrupt
+        if poll in polls:
+            polls[poll]()
+
+    refreshed = []
+
+    def refresh_students(student_ids, scopes):
+        refreshed.append((poll, sorted(student_ids)))
+        if failing in student_ids:
+            raise sqlite3.IntegrityError("NOT NULL constraint failed")
+        return len(student_ids)
+
+    signature_reads = []
+    read_signatures = main.SqliteRepository.student_score_signatures
+
+    def student_score_signatures(self):
+        signature_reads.append(poll)
+        return read_signatures(self)
+
+    monkeypatch.setattr(main.time, "sleep", fake_sleep)
+    monkeypatch.setattr(main, "refresh_students", refresh_students)
+    monkeypatch.setattr(main.SqliteRepository, "student_score_signatures", student_score_signatures)
+
+    main.main_watch(("all",))
+
+    # Без зміни watermark підписи не читаються (крім повторів для збійного учня)
+    assert signature_reads == [0, 2, 3, 4, 5]
+    assert refreshed == [
+        (2, [failing, healthy]), (2, [failing]), (2, [healthy]),  # порція, потім поштучно
+        (3, [failing]),                                            # повтор через 1 опитування
+        (4, [healthy]),                                            # збійний учень чекає 2 опитування
+        (5, [failing]),
+    ]
+
+
+@pytest.mark.parametrize("changed", [False, True])
+def test_watch_full_diff_catches_regraded_rows(db_path, monkeypatch, changed):
+    monkeypatch.setattr(main, "WATCH_FULL_DIFF_EVERY", 3)
+    poll = 0
+
+    def fake_sleep(seconds):
+        nonlocal poll
+        poll += 1
+        if poll > 3:
+            raise KeyboardInterrupt
+        if poll == 1 and changed:
+            # Інша дата при тій самій кількості й сумі балів: watermark не змінюється
+            with sqlite3.connect(db_path) as conn:
+                conn.execute("UPDATE student_test SET date_time_taken = '2030-01-01 10:00:00' "
+                             "WHERE id = (SELECT MIN(id) FROM student_test WHERE state = 1 AND student_id = 4)")
+
+    refreshed = []
+    monkeypatch.setattr(main.time, "sleep", fake_sleep)
+    monkeypatch.setattr(main, "refresh_students", lambda ids, scopes: refreshed.append((poll, ids)) or 0)
+
+    main.main_watch(("all",))
+
+    assert refreshed == ([(3, [4])] if changed else [])